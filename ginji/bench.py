@@ -0,0 +1,209 @@
+"""
+Benchmark motion detection and encoding without a camera, by replaying a synthetic scene or a
+recorded clip through MotionInput and VideoOutput. Results are saved as json so runs can be
+compared across versions and machines.
+
+    ginji bench --events 10 --output before.json
+    ginji bench --events 10 --compare before.json
+"""
+
+import json
+import os
+import platform
+import resource
+import tempfile
+import time
+from importlib import metadata
+
+from ginji.config import config
+from ginji.metrics import registry
+
+
+def _version():
+    try:
+        return metadata.version('ginji')
+    except metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+def match_events(detected, expected):
+    """
+    Pair each expected event with the first detected event that overlaps it.
+
+    :param detected: a list of (start, end) seconds
+    :param expected: a list of (start, end) seconds
+    :return: a dict of counts, precision and recall
+
+    """
+    unmatched = list(detected)
+    matched = 0
+    for start, end in expected:
+        for d in unmatched:
+            if d[0] <= end and d[1] >= start:
+                unmatched.remove(d)
+                matched += 1
+                break
+    return {
+        'expected': len(expected),
+        'detected': len(detected),
+        'matched': matched,
+        'precision': round(matched / len(detected), 3) if detected else None,
+        'recall': round(matched / len(expected), 3) if expected else None
+        }
+
+
+def run(clip=None, truth=None, events=5, encode=True, fourcc='mp4v', **motion_config):
+    """
+    Run the motion input over a whole scene, as fast as it'll go (or in real time, with detector
+    processes), in a temporary root.
+
+    :param clip: a video file to replay; a synthetic scene is made up if this is None
+    :param truth: (start, end) seconds of each event in the clip, if they're known
+    :param events: how many events the synthetic scene should have
+    :param encode: whether to encode each event with VideoOutput.make_video as well
+    :param fourcc: the codec to encode with; mp4v is in every OpenCV build, and None means the
+        configured one
+    :param motion_config: overrides for the motion input config, e.g. detector='mog2'
+    :return: a dict of results
+
+    """
+    from ginji.inputs.motion import MotionInput
+    from ginji.inputs.sources import SyntheticSource
+    from ginji.outputs.media import VideoOutput
+
+    class EventLog(VideoOutput):
+        def __init__(self):
+            super(EventLog, self).__init__()
+            self.events = []
+            self.failed = 0
+
+        def fire(self, frames, fps, **kwargs):
+            timestamps = frames.timestamps
+            self.events.append((float(timestamps[0]), float(timestamps[-1])))
+            if encode:
+                try:
+                    super(EventLog, self).fire(frames, fps, **kwargs)
+                except Exception:
+                    self.failed += 1
+                    raise
+
+    if clip is None:
+        source, source_options = 'synthetic', {'events': events}
+    else:
+        source, source_options = 'file', {'path': clip}
+    # timestamps start at 0, so events can be compared with the truth directly
+    source_options['start'] = 0
+    motion_config = {
+        **config.input_config.get('motion', {}),
+        'source': source,
+        'source_options': source_options,
+        **motion_config
+        }
+    # the shared frame ring doesn't hold capture back, so detector processes would only see
+    # whichever frames they happened to catch; play in real time and count the drops instead
+    source_options['realtime'] = motion_config.get('processes', 0) > 0
+    if clip is None:
+        scene = SyntheticSource(motion_config.get('width', 640), motion_config.get('height', 480),
+                                motion_config.get('framerate', 30), **source_options)
+        truth = scene.events
+
+    original = config.root, config.input_config, config.output_config
+    with tempfile.TemporaryDirectory() as root:
+        config.root = root
+        config.input_config = {**config.input_config, 'motion': motion_config}
+        # posters, streaming and renditions each have their own threads and processes; leave
+        # them out so runs can be compared
+        config.output_config = {
+            **config.output_config,
+            'video': {
+                **config.output_config.get('video', {}),
+                **({'fourcc': fourcc} if fourcc else {}),
+                'streaming': False,
+                'poster': False,
+                'renditions': {}
+                }
+            }
+        registry.reset()
+        try:
+            motion_input = MotionInput()
+            output = EventLog()
+            motion_input.register_outputs(output)
+            started = time.perf_counter()
+            motion_input.start()
+            motion_input.thread.join()
+            detected = time.perf_counter() - started
+            # waits for the outputs to finish everything that's queued
+            motion_input.stop()
+            elapsed = time.perf_counter() - started
+            effective_config = motion_input._config
+            effective_fourcc = output.fourcc
+        finally:
+            config.root, config.input_config, config.output_config = original
+
+    snapshot = registry.snapshot()
+    frames = snapshot.get('ginji_frames_total', 0)
+    prefix = 'ginji_stage_seconds{stage='
+    stages = {k[len(prefix):-1]: v for k, v in snapshot.items() if k.startswith(prefix)}
+    prefix = 'ginji_dropped_frames_total{reason='
+    dropped = {k[len(prefix):-1]: v for k, v in snapshot.items() if k.startswith(prefix)}
+    # ru_maxrss is in kilobytes on linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    results = {
+        'ginji': _version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'source': clip or 'synthetic',
+        'frames': frames,
+        'seconds': round(elapsed, 3),
+        'detect_seconds': round(detected, 3),
+        'fps': round(frames / detected, 2) if detected else None,
+        'dropped_frames': dropped,
+        'stages': stages,
+        'peak_rss_mb': round(peak_rss, 1),
+        'children_peak_rss_mb': round(children_rss, 1),
+        'events': match_events(output.events, truth) if truth is not None else {'detected': len(output.events)},
+        'fourcc': effective_fourcc if encode else None,
+        # the encode times don't mean much if any of these are failures
+        'encode_failures': output.failed,
+        'config': effective_config
+        }
+    return results
+
+
+def save(results, path=None):
+    """
+    :param results: from run()
+    :param path: defaults to somewhere in config.root/benchmarks
+    :return: path
+
+    """
+    if path is None:
+        folder = os.path.join(config.root, 'benchmarks')
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        path = os.path.join(folder, f'bench_{time.strftime("%Y%m%d-%H%M%S")}.json')
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, default=str)
+    return path
+
+
+def compare(before, after):
+    """
+    :param before: earlier results, e.g. loaded from a saved file
+    :param after: newer results
+    :return: a list of (what, before, after, percentage change) for the headline numbers
+
+    """
+    rows = [
+        ('fps', before.get('fps'), after.get('fps')),
+        ('peak_rss_mb', before.get('peak_rss_mb'), after.get('peak_rss_mb')),
+        ('recall', before['events'].get('recall'), after['events'].get('recall')),
+        ('precision', before['events'].get('precision'), after['events'].get('precision'))
+        ]
+    for stage in sorted(set(before.get('stages', {})) | set(after.get('stages', {}))):
+        p95 = [r['stages'].get(stage, {}).get('p95') for r in (before, after)]
+        rows.append((f'{stage} p95 ms', *[round(1000 * p, 3) if p is not None else None for p in p95]))
+    return [(what, a, b, round(100 * (b - a) / a, 1) if a and b is not None else None)
+            for what, a, b in rows]
@@ -1,10 +1,17 @@
 import click
+import cProfile
+import json
+import logging
+import multiprocessing
+import pstats
+import sys
+import threading
 import time
-from ginji.config import config, logger
-from ginji.inputs import MotionInput
-from ginji.outputs import VideoOutput
-from ginji.connectors import uploaders, notifiers
+import urllib.request
+from ginji import metrics, profiling, registry
+from ginji.config import config, handler, logger
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
 
 
@@ -20,26 +27,89 @@ def cli(ctx):
     A command line interface for working with ginji. If only it were that easy working with the actual cat.
     Run 'ginji <cmd> -h' for help with each subcommand.
     """
-    active_connectors = [k for k, v in config.connector_config.items() if v.get('active', True)]
+    # nothing is imported or connected until a command asks for it
+    known = registry.available('connectors')
     ctx.obj = {
-        'connectors': [c() for c in (uploaders + notifiers) if c.config_name in active_connectors]
+        'connectors': [k for k, v in config.connector_config.items() if v.get('active', True) and k in known]
         }
 
 
+def _connectors(names):
+    return [registry.load('connectors', name)() for name in names]
+
+
+def _pipeline(connectors):
+    motion_input = registry.load('inputs', 'motion')()
+    video_output = registry.load('outputs', 'video')()
+    motion_input.register_outputs(video_output)
+    video_output.register_connectors(*_connectors(connectors))
+    return motion_input, video_output
+
+
+def _check_camera(name):
+    if name not in config.cameras:
+        raise click.BadParameter(f'"{name}" isn\'t one of the cameras in the config.', param_hint='--camera')
+
+
+def _use_camera(name):
+    _check_camera(name)
+    config.use_camera(name)
+    if not os.path.exists(config.root):
+        os.makedirs(config.root)
+    handler.setFormatter(logging.Formatter(f'%(asctime)s %(levelname)-8s {name}: %(message)s'))
+
+
 @cli.command(short_help='Start motion detection.')
 @click.option('--tidy/--no-tidy', default=True,
               help='Tidy up any files that haven\'t been uploaded yet before initialising the motion detection.')
 @click.option('--interval', type=int, help='Attempt a tidy every n seconds. Optional.')
+@click.option('--camera', 'cameras', multiple=True,
+              help='Only run this camera from the config; can be given more than once. Optional.')
 @click.pass_context
-def motion(ctx, tidy, interval):
-    motion_input = MotionInput()
-    video_output = VideoOutput()
-    motion_input.register_outputs(video_output)
-    video_output.register_connectors(*ctx.obj.get('connectors', []))
+def motion(ctx, tidy, interval, cameras):
+    """
+    Watch for motion. If the config has a "cameras" section, each camera runs in a process of its own,
+    with its own files; they all use the same connectors.
+    """
+    cameras = list(cameras or config.cameras)
+    if not cameras:
+        _watch(ctx.obj['connectors'], tidy, interval)
+        return
+    for name in cameras:
+        _check_camera(name)
+    # nothing has started any threads yet, so forking is safe
+    processes = [multiprocessing.get_context('fork').Process(target=_watch_camera,
+                                                             args=(name, ctx.obj['connectors'], tidy, interval),
+                                                             name=f'ginji-{name}')
+                 for name in cameras]
+    for p in processes:
+        p.start()
+    try:
+        for p in processes:
+            p.join()
+    except KeyboardInterrupt:
+        # every camera gets the interrupt too, and shuts itself down
+        for p in processes:
+            p.join()
+    failed = [p.name for p in processes if p.exitcode]
+    if failed:
+        click.echo(f'{", ".join(failed)} stopped with an error.', err=True)
+        ctx.exit(1)
+
+
+def _watch_camera(name, connectors, tidy, interval):
+    _use_camera(name)
+    _watch(connectors, tidy, interval)
+
+
+def _watch(connectors, tidy, interval):
+    motion_input, video_output = _pipeline(connectors)
 
     if tidy:
         video_output.tidy()
 
+    metrics.serve(config.metrics_port)
+    profiling.install_toggle()
     motion_input.start()
 
     if interval is None:
@@ -49,8 +119,18 @@ def motion(ctx, tidy, interval):
         interval_tidy = True
     while True:
         try:
-            time.sleep(interval)
-            if interval_tidy and not motion_input.value and not video_output.processing:
+            motion_input.thread.join(interval)
+            if not motion_input.thread.is_alive():
+                motion_input.stop()
+                if motion_input.error is not None:
+                    # anything still queued is picked up again next time
+                    click.echo(f'Motion detection stopped with an error: {motion_input.error}', err=True)
+                    sys.exit(1)
+                # a replayed file has run out
+                click.echo('Source finished.')
+                video_output.wait_for_uploads()
+                break
+            if interval_tidy and not motion_input.value and motion_input.pending == 0:
                 video_output.tidy()
         except KeyboardInterrupt:
             click.echo('Exiting.')
@@ -59,26 +139,215 @@ def motion(ctx, tidy, interval):
             break
 
 
+@cli.command(short_help='Run motion detection for a while and profile it.')
+@click.option('--seconds', type=float, default=30, help='How long to run for.')
+@click.option('--frames', type=int, help='Stop after this many frames instead. Optional.')
+@click.option('--mode', type=click.Choice(['sample', 'cprofile']), default='sample',
+              help='A sampling profiler on every thread (cheap), or cProfile on the detection thread (exact, but slow).')
+@click.option('--interval', type=float, default=0.005, help='Seconds between samples.')
+@click.option('--camera', help='Which camera from the config to profile, if there are several. Optional.')
+@click.pass_context
+def profile(ctx, seconds, frames, mode, interval, camera):
+    """
+    Run the motion detection like 'ginji motion' does, and write the profile to config.root/profiles:
+    collapsed stacks (for flamegraph.pl or speedscope) in sample mode, or pstats in cprofile mode.
+    """
+    if camera is not None:
+        _use_camera(camera)
+    motion_input, video_output = _pipeline(ctx.obj['connectors'])
+    frame_count = metrics.registry.counter('ginji_frames_total')
+    first_frame = frame_count.value
+
+    if mode == 'cprofile':
+        # cProfile only sees the thread it's running in, so run the detection loop inside it
+        profiler = cProfile.Profile()
+        motion_input.thread = threading.Thread(target=profiler.runcall, args=(motion_input.run,))
+    else:
+        profiler = profiling.SamplingProfiler(interval)
+        profiler.start()
+
+    started = time.time()
+    motion_input.start()
+    try:
+        while motion_input.thread.is_alive():
+            time.sleep(0.1)
+            done = frame_count.value - first_frame
+            if (frames is not None and done >= frames) or (frames is None and time.time() - started >= seconds):
+                break
+    except KeyboardInterrupt:
+        pass
+    motion_input.stop()
+    elapsed = time.time() - started
+    done = frame_count.value - first_frame
+    click.echo(f'Profiled {done} frames in {elapsed:.1f}s ({done / elapsed:.1f} fps).')
+
+    if mode == 'cprofile':
+        path = profiling.output_path('cprofile', 'pstats')
+        profiler.dump_stats(path)
+        pstats.Stats(path).sort_stats('cumulative').print_stats(20)
+    else:
+        profiler.stop()
+        path = profiler.write(profiling.output_path('sample', 'collapsed'))
+    click.echo(f'Wrote {path}')
+
+
+@cli.command(short_help='Benchmark detection and encoding without a camera.')
+@click.option('--clip', type=click.Path(exists=True, dir_okay=False),
+              help='Replay this video instead of a synthetic scene. Optional.')
+@click.option('--truth', type=click.Path(exists=True, dir_okay=False),
+              help='A json list of [start, end] seconds for each event in the clip, for the accuracy. Optional.')
+@click.option('--events', type=int, default=5, help='How many events the synthetic scene has.')
+@click.option('--detector', help='Use this detector instead of the configured one. Optional.')
+@click.option('--processes', type=int, help='Use this many detector processes instead of the configured number. Optional.')
+@click.option('--encode/--no-encode', default=True, help='Encode each event too.')
+@click.option('--fourcc', default='mp4v',
+              help='Encode with this codec; "config" for the configured one. mp4v works with any OpenCV build.')
+@click.option('--output', type=click.Path(dir_okay=False), help='Where to save the results. Optional.')
+@click.option('--compare', type=click.Path(exists=True, dir_okay=False), help='Earlier results to compare with. Optional.')
+def bench(clip, truth, events, detector, processes, encode, fourcc, output, compare):
+    """
+    Replay a synthetic scene (or a clip) through the motion detection as fast as it'll go, and report the frame
+    rate, how long each stage takes, peak memory and how many of the events were found. Results are saved as
+    json in config.root/benchmarks unless --output is given.
+    """
+    from ginji import bench as benchmarks
+    overrides = {k: v for k, v in {'detector': detector, 'processes': processes}.items() if v is not None}
+    if truth is not None:
+        with open(truth, 'r') as f:
+            truth = [tuple(e) for e in json.load(f)]
+    results = benchmarks.run(clip, truth, events, encode, None if fourcc == 'config' else fourcc, **overrides)
+    click.echo(f'{results["frames"]} frames in {results["detect_seconds"]:.1f}s ({results["fps"]} fps); '
+               f'{results["seconds"]:.1f}s including the outputs')
+    for name, stage in sorted(results['stages'].items(), key=lambda x: -x[1].get('mean', 0) * x[1]['count']):
+        if 'p50' in stage:
+            click.echo(f'    {name}: p50 {1000 * stage["p50"]:.2f}ms, p95 {1000 * stage["p95"]:.2f}ms, '
+                       f'p99 {1000 * stage["p99"]:.2f}ms ({stage["count"]} calls)')
+    if results['dropped_frames']:
+        click.echo('dropped frames: ' + ', '.join(f'{k} {v}' for k, v in results['dropped_frames'].items()))
+    if results['encode_failures']:
+        click.echo(f'{results["encode_failures"]} events failed to encode with {results["fourcc"]}, '
+                   f'so the encode times are meaningless; try --fourcc mp4v')
+    click.echo(f'peak rss {results["peak_rss_mb"]}MB (children {results["children_peak_rss_mb"]}MB)')
+    click.echo('events: ' + ', '.join(f'{k} {v}' for k, v in results['events'].items()))
+    if compare is not None:
+        with open(compare, 'r') as f:
+            before = json.load(f)
+        click.echo(f'compared with {compare} (ginji {before.get("ginji")}):')
+        for what, a, b, change in benchmarks.compare(before, results):
+            click.echo(f'    {what}: {a} -> {b}' + (f' ({change:+}%)' if change is not None else ''))
+    click.echo(f'Wrote {benchmarks.save(results, output)}')
+
+
+def _motioneye_moves(video_output):
+    """Work out where each motioneye video should go; the files themselves aren't touched."""
+    moves = []
+    for root, dirs, files in os.walk(config.root):
+        # media is where they're going, not where they come from
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != video_output.file_root]
+        for f in files:
+            if not f.endswith(video_output.filetype):
+                continue
+            video_date = root.split('/')[-1]
+            video_time = f.split(os.extsep)[0]
+            try:
+                video_datetime = dt.strptime(f'{video_date} {video_time}', '%Y-%m-%d %H-%M-%S').timestamp()
+            except:
+                continue
+            moves.append((os.path.join(root, f), video_output.make_filename(video_datetime, 2)))
+    return moves
+
+
+def _move(move):
+    src, dst = move
+    if os.path.exists(dst):
+        logger.error(f'Not moving {src}: {dst} already exists.')
+        return False
+    os.rename(src, dst)
+    return True
+
+
 @cli.command(short_help='Manually initiate a tidy-up of the output folder.')
 @click.option('--motioneye', is_flag=True, default=False)
+@click.option('--workers', type=int, default=4, help='How many files to hash and upload at once.')
+@click.option('--dry-run', is_flag=True, default=False, help='Show what would happen without doing it.')
+@click.option('--camera', help='Sweep this camera\'s output folder, if the config has several. Optional.')
 @click.pass_context
-def sweep(ctx, motioneye):
-    video_output = VideoOutput()
-    video_output.register_connectors(*ctx.obj.get('connectors', []))
+def sweep(ctx, motioneye, workers, dry_run, camera):
+    """
+    Upload everything that's been left in the output folder. It's safe to interrupt: anything
+    that's already been uploaded is skipped next time.
+    """
+    if camera is not None:
+        _use_camera(camera)
+    # a dry run doesn't log in anywhere, make any folders, or touch the upload queue, which
+    # motion may be working through at the same time
+    video_output = registry.load('outputs', 'video')(create=not dry_run)
+    workers = max(1, workers)
+    moves = _motioneye_moves(video_output) if motioneye else []
 
+    if dry_run:
+        from ginji.outputs import uploads
+        if motioneye:
+            click.echo(f'Would move {len(moves)} motioneye videos into {video_output.file_root}.')
+        files = os.listdir(video_output.file_root) if os.path.exists(video_output.file_root) else []
+        sizes = {os.path.join(video_output.file_root, f): os.path.getsize(os.path.join(video_output.file_root, f))
+                 for f in files if f.endswith(video_output.filetype) and not f.startswith('temp_')}
+        sizes.update({dst: os.path.getsize(src) for src, dst in moves})
+        ledger = uploads.read_ledger()
+        todo = [f for f in sizes if ledger.get(f) != 'done']
+        click.echo(f'Would upload {len(todo)} files ({sum(sizes[f] for f in todo) / 1e6:.1f} MB); '
+                   f'{len(sizes) - len(todo)} are already done.')
+        return
+
+    video_output.register_connectors(*_connectors(ctx.obj['connectors']))
+
+    started = time.time()
     # move everything into the right place
-    if motioneye:
-        for root, _, files in os.walk(config.root):
-            for f in files:
-                if not f.endswith(video_output.filetype):
-                    continue
-                video_date = root.split('/')[-1]
-                video_time = f.split(os.extsep)[0]
-                try:
-                    video_datetime = dt.strptime(f'{video_date} {video_time}', '%Y-%m-%d %H-%M-%S').timestamp()
-                except:
-                    continue
-                new_fn = video_output.make_filename(video_datetime, 2)
-                os.rename(os.path.join(root, f), new_fn)
-
-    video_output.tidy()
+    if moves:
+        with ThreadPoolExecutor(workers) as pool:
+            moved = sum(pool.map(_move, moves))
+        click.echo(f'Moved {moved} of {len(moves)} motioneye videos.')
+
+    def hashed(done, total):
+        click.echo(f'\rQueued {done}/{total} files', nl=False)
+
+    video_output.upload_queue.workers = workers
+    video_output.tidy(workers=workers, progress=hashed)
+    click.echo()
+    # uploads start as soon as files are queued, so count from the beginning
+    backlog = len(video_output.upload_queue.pending()) + video_output.upload_queue.finished_since(started)[0]
+
+    def uploaded():
+        files, size = video_output.upload_queue.finished_since(started)
+        rate = size / 1e6 / max(time.time() - started, 1e-6)
+        click.echo(f'\rUploaded {files}/{backlog} files, {size / 1e6:.1f} MB ({rate:.2f} MB/s)', nl=False)
+
+    video_output.wait_for_uploads(progress=uploaded)
+    uploaded()
+    click.echo()
+    left = len(video_output.upload_queue.pending())
+    click.echo(f'Finished in {time.time() - started:.0f}s; {left} files left to retry later.')
+
+
+@cli.command(short_help='Show performance stats from a running motion process.')
+@click.option('--port', type=int, default=None, help='The metrics port, if it isn\'t the one in the config.')
+@click.option('--prometheus', is_flag=True, default=False, help='Print the raw prometheus metrics.')
+def stats(port, prometheus):
+    url = f'http://127.0.0.1:{port or config.metrics_port}/'
+    try:
+        with urllib.request.urlopen(url + ('metrics' if prometheus else 'stats'), timeout=5) as r:
+            body = r.read().decode()
+    except OSError as e:
+        raise click.ClickException(f'Couldn\'t get stats from {url} ({e}); is ginji motion running?')
+    if prometheus:
+        click.echo(body, nl=False)
+        return
+    for name, value in json.loads(body).items():
+        if not isinstance(value, dict):
+            click.echo(f'{name}: {value:g}')
+        elif 'p50' in value:
+            click.echo(f'{name}: n={value["count"]} mean={1000 * value["mean"]:.2f}ms '
+                       f'p50={1000 * value["p50"]:.2f}ms p95={1000 * value["p95"]:.2f}ms '
+                       f'p99={1000 * value["p99"]:.2f}ms max={1000 * value["max"]:.2f}ms')
+        else:
+            click.echo(f'{name}: n={value["count"]}')
@@ -8,10 +8,12 @@ class Config(object):
         config_dict = self._load(path)
         self.root = config_dict.get('root', os.path.dirname(os.path.realpath(__file__ + '/..')))
         self.file_prefix = config_dict.get('file_prefix', 'cat')
+        self.metrics_port = config_dict.get('metrics_port', 9180)
         self._log_level = config_dict.get('log_level', 'DEBUG').upper()
         self.input_config = config_dict.get('inputs', {})
         self.output_config = config_dict.get('outputs', {})
         self.connector_config = config_dict.get('connectors', {})
+        self.cameras = config_dict.get('cameras', {})
 
     def _load(self, path):
         if path is None:
@@ -24,6 +26,25 @@ class Config(object):
         else:
             return {}
 
+    def use_camera(self, name):
+        """
+        Switch this process over to one of several cameras: its settings are laid over the motion
+        input's, and it gets its own root and file prefix so that cameras never touch each other's
+        files. Connectors are the same for all of them.
+
+        :param name: a key in cameras
+
+        """
+        camera = dict(self.cameras[name])
+        index = list(self.cameras).index(name)
+        self.root = camera.pop('root', os.path.join(self.root, 'cameras', name))
+        self.file_prefix = camera.pop('file_prefix', f'{self.file_prefix}_{name}')
+        self.metrics_port = camera.pop('metrics_port', self.metrics_port + index if self.metrics_port else 0)
+        self.input_config = {
+            **self.input_config,
+            'motion': {**self.input_config.get('motion', {}), **camera}
+            }
+
     @property
     def log_level(self):
         return logging.getLevelName(self._log_level)
@@ -36,9 +57,11 @@ class Config(object):
         return {
             'root': self.root,
             'file_prefix': self.file_prefix,
+            'metrics_port': self.metrics_port,
             'inputs': self.input_config,
             'outputs': self.output_config,
             'connectors': self.connector_config,
+            'cameras': self.cameras,
             'log_level': self.log_level
             }
 
@@ -1,7 +1,18 @@
-from .s3_uploader import S3Uploader
-from .drive_uploader import GoogleDriveUploader
-from .ifttt_notifier import IFTTTNotifier
+from ginji import registry
 
+_classes = {
+    'S3Uploader': 's3',
+    'GoogleDriveUploader': 'google_drive',
+    'IFTTTNotifier': 'ifttt'
+    }
 
-uploaders = [S3Uploader, GoogleDriveUploader]
-notifiers = [IFTTTNotifier]
+
+def __getattr__(name):
+    # the connectors pull in big client libraries, so they're only imported when asked for
+    if name in _classes:
+        return registry.load('connectors', _classes[name])
+    if name == 'uploaders':
+        return [registry.load('connectors', n) for n in ('s3', 'google_drive')]
+    if name == 'notifiers':
+        return [registry.load('connectors', 'ifttt')]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
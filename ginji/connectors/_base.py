@@ -39,6 +39,11 @@ class BaseUploader(BaseConnector, ABC):
 class BaseNotifier(BaseConnector, ABC):
     config_name = 'notifier'
     connector_type = 'notifier'
+    # the uploaders whose urls this notifier needs; None waits for all of them
+    requires = None
+    # if more than 0, the upload queue holds notifications back for this many seconds and then
+    # hands everything that's ready to run_batch() at once
+    coalesce_seconds = 0
 
     @abstractmethod
     def run(self, uploads=None, *args, **kwargs):
@@ -1,20 +1,46 @@
 import argparse
+import json
+import mimetypes
+import os
+import threading
 
 import httplib2
 import oauth2client
 from apiclient import discovery
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload
 from oauth2client import client, tools
 
-from ginji.config import logger
+from ginji.config import config, logger
 from ._base import BaseUploader
 
+# drive wants chunks in multiples of 256KB
+CHUNK_UNIT = 256 * 1024
+
 
 class GoogleDriveUploader(BaseUploader):
     config_name = 'google_drive'
 
     def __init__(self):
         super(GoogleDriveUploader, self).__init__()
-        self.service = self.auth()
+        self.credentials = self.auth()
+        self.chunk_size = max(1, round(self._config['chunk_mb'] * 1024 * 1024 / CHUNK_UNIT)) * CHUNK_UNIT
+        self.session_path = os.path.join(config.root, 'drive_sessions.json')
+        # called with (file, fraction uploaded) after every chunk, if it's set
+        self.progress = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def load_config(self):
+        basic_config = super(GoogleDriveUploader, self).load_config()
+        return {
+            'credential_path': basic_config.get('credential_path', '.credentials/drive_credentials.json'),
+            'client_secret': basic_config.get('client_secret', '.credentials/client_secret.json'),
+            'scopes': basic_config.get('scopes', 'https://www.googleapis.com/auth/drive'),
+            'app_name': basic_config.get('app_name', 'ginji'),
+            'chunk_mb': basic_config.get('chunk_mb', 8),
+            'folder_id': basic_config.get('folder_id', None)
+            }
 
     def auth(self):
         store = oauth2client.file.Storage(self._config['credential_path'])
@@ -26,14 +52,75 @@ class GoogleDriveUploader(BaseUploader):
             credentials = tools.run_flow(flow, store, argparse.ArgumentParser(
                 parents=[tools.argparser]).parse_args())
             logger.debug('Storing credentials to ' + self._config['credential_path'])
-        http = credentials.authorize(httplib2.Http())
-        service = discovery.build('drive', 'v3', http=http)
-        return service
+        return credentials
+
+    @property
+    def service(self):
+        # httplib2 isn't thread-safe, so each upload thread gets its own connection
+        if getattr(self._local, 'service', None) is None:
+            http = self.credentials.authorize(httplib2.Http())
+            self._local.service = discovery.build('drive', 'v3', http=http)
+        return self._local.service
+
+    def _sessions(self):
+        if not os.path.exists(self.session_path):
+            return {}
+        with open(self.session_path, 'r') as f:
+            return json.load(f)
+
+    def _save_session(self, key, uri):
+        with self._lock:
+            sessions = self._sessions()
+            if uri is None:
+                sessions.pop(key, None)
+            else:
+                sessions[key] = uri
+            tmp = self.session_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(sessions, f)
+            os.replace(tmp, self.session_path)
 
     def run(self, file):
-        metadata = {
-            'name': file
-            }
-        self.service.files().create(body=metadata, media_body=file).execute()
+        st = os.stat(file)
+        # a session is only any use for exactly the same file
+        key = f'{file}:{st.st_size}:{st.st_mtime}'
+        with self._lock:
+            uri = self._sessions().get(key)
+        try:
+            self._upload(file, key, uri)
+        except HttpError as e:
+            if uri is None or e.resp.status not in (404, 410):
+                raise
+            # the session has expired, so start again from scratch
+            logger.debug(f'google drive session for {file} has expired')
+            self._save_session(key, None)
+            self._upload(file, key, None)
+        self._save_session(key, None)
         logger.debug(f'Uploaded {file} to Google Drive.')
         return ''
+
+    def _upload(self, file, key, uri):
+        metadata = {
+            'name': os.path.basename(file)
+            }
+        if self._config['folder_id']:
+            metadata['parents'] = [self._config['folder_id']]
+        mimetype = mimetypes.guess_type(file)[0] or 'application/octet-stream'
+        media = MediaFileUpload(file, mimetype=mimetype, chunksize=self.chunk_size, resumable=True)
+        request = self.service.files().create(body=metadata, media_body=media)
+        if uri is not None:
+            # pick up an old session: in its error state, the request asks drive how much
+            # already arrived before sending anything
+            request.resumable_uri = uri
+            request._in_error_state = True
+        response = None
+        while response is None:
+            status, response = request.next_chunk(num_retries=3)
+            if request.resumable_uri != uri:
+                uri = request.resumable_uri
+                self._save_session(key, uri)
+            if status is not None:
+                logger.debug(f'{os.path.basename(file)}: {status.progress():.0%} uploaded to google drive')
+                if self.progress is not None:
+                    self.progress(file, status.progress())
+        return response
@@ -0,0 +1,57 @@
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def session():
+    """
+    One keep-alive session shared by every connector that talks http, so repeat requests to the
+    same host reuse a connection instead of doing a new TLS handshake each time.
+
+    :return: requests.Session
+
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def connection_stats(url):
+    """
+    :param url: any url on the host
+    :return: (connections opened, requests made) for that host's pool in the shared session
+
+    """
+    host = urlparse(url).hostname
+    pools = session().get_adapter(url).poolmanager.pools
+    # requests keys its pools by tls settings too, so there can be more than one per host
+    matching = [pools[k] for k in pools.keys() if k.key_host == host]
+    return sum(p.num_connections for p in matching), sum(p.num_requests for p in matching)
+
+
+class RateLimiter(object):
+    """Spaces calls out so there are never more than per_minute in any minute; 0 means no limit."""
+
+    def __init__(self, per_minute=0):
+        self.interval = 60 / per_minute if per_minute else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            delay = max(0, self._next - now)
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
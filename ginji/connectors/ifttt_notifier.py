@@ -1,24 +1,87 @@
-import requests
+import time
 
 from ._base import BaseNotifier
+from .http import RateLimiter, connection_stats, session
 from ginji.config import logger
 
 
 class IFTTTNotifier(BaseNotifier):
     config_name = 'ifttt'
+    requires = ('s3',)
+
+    def __init__(self):
+        super(IFTTTNotifier, self).__init__()
+        self.limiter = RateLimiter(self._config['max_per_minute'])
+        self.coalesce_seconds = self._config['coalesce_seconds']
+        self.sent = 0
+        self.merged = 0
+        self.failed = 0
+        self.latency = 0
+        self.max_latency = 0
+        self._total_latency = 0
 
     def load_config(self):
         basic_config = super(IFTTTNotifier, self).load_config()
         return {
-            'url': basic_config.get('url', 'invalid-url')
+            'url': basic_config.get('url', 'invalid-url'),
+            'timeout': basic_config.get('timeout', 10),
+            'coalesce_seconds': basic_config.get('coalesce_seconds', 0),
+            'max_per_minute': basic_config.get('max_per_minute', 0)
             }
 
     def run(self, uploads=None, value2='', value3=''):
-        payload = {
-            'value1': uploads.get('s3', ''),
+        self._post(self._payload(uploads, value2, value3))
+
+    def run_batch(self, calls):
+        """
+        Send several notifications as one, e.g. everything from the last coalesce_seconds.
+
+        :param calls: a list of (uploads, value2, value3), oldest first
+
+        """
+        payloads = [self._payload(*call) for call in calls]
+        payload = dict(payloads[-1])
+        if len(payloads) > 1:
+            payload['value2'] = payloads[0]['value2']
+            payload['value3'] = f'{payload["value3"]} (and {len(payloads) - 1} more)'
+        self._post(payload)
+        self.merged += len(payloads) - 1
+
+    @staticmethod
+    def _payload(uploads=None, value2='', value3=''):
+        return {
+            'value1': (uploads or {}).get('s3', ''),
             'value2': value2,
             'value3': value3
             }
 
-        requests.post(self._config['url'], payload)
-        logger.debug('Sent payload to IFTTT notifier.')
+    def _post(self, payload):
+        self.limiter.wait()
+        start = time.perf_counter()
+        try:
+            r = session().post(self._config['url'], payload, timeout=self._config['timeout'])
+            r.raise_for_status()
+        except Exception:
+            self.failed += 1
+            raise
+        self.latency = time.perf_counter() - start
+        self.max_latency = max(self.max_latency, self.latency)
+        self._total_latency += self.latency
+        self.sent += 1
+        logger.debug(f'Sent payload to IFTTT notifier: {self.stats()}')
+
+    def stats(self):
+        try:
+            connections, requests = connection_stats(self._config['url'])
+        except Exception:
+            connections, requests = 0, 0
+        return {
+            'sent': self.sent,
+            'merged': self.merged,
+            'failed': self.failed,
+            'latency': round(self.latency, 3),
+            'mean_latency': round(self._total_latency / self.sent, 3) if self.sent else 0,
+            'max_latency': round(self.max_latency, 3),
+            'connections': connections,
+            'requests': requests
+            }
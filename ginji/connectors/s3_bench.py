@@ -0,0 +1,89 @@
+"""
+Benchmark S3 uploads against moto's in-memory S3, so transfer settings can be compared without a
+real bucket (or an uplink). Needs moto: pip install ginji[bench].
+
+    python -m ginji.connectors.s3_bench --files 20 --size-mb 16 --workers 4
+"""
+
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+from ginji.config import config
+
+
+def benchmark(files=20, size_mb=16, workers=4, **s3_config):
+    """
+    Upload some random files through S3Uploader and time them.
+
+    :param files: how many files to upload
+    :param size_mb: the size of each file
+    :param workers: how many files to upload at once (like the upload queue's workers)
+    :param s3_config: overrides for the s3 connector config, e.g. max_concurrency
+    :return: a dict of results
+
+    """
+    try:
+        from moto import mock_aws
+    except ImportError:
+        raise ImportError('The S3 benchmark needs moto: pip install ginji[bench]')
+    from .s3_uploader import S3Uploader
+
+    s3_config = {
+        'host': None,
+        'bucket': 'ginji-bench',
+        **s3_config
+        }
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    original = config.connector_config.get('s3')
+    config.connector_config['s3'] = s3_config
+    try:
+        with mock_aws(), tempfile.TemporaryDirectory() as tmp:
+            uploader = S3Uploader()
+            uploader.client.create_bucket(Bucket=s3_config['bucket'])
+            paths = []
+            for i in range(files):
+                path = os.path.join(tmp, f'bench_{i}.mp4')
+                with open(path, 'wb') as f:
+                    f.write(os.urandom(int(size_mb * 1024 * 1024)))
+                paths.append(path)
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max(1, workers)) as pool:
+                urls = list(pool.map(uploader.run, paths))
+            elapsed = time.perf_counter() - start
+    finally:
+        if original is None:
+            config.connector_config.pop('s3', None)
+        else:
+            config.connector_config['s3'] = original
+    return {
+        'files': files,
+        'size_mb': size_mb,
+        'workers': workers,
+        'seconds': round(elapsed, 3),
+        'mb_per_second': round(files * size_mb / elapsed, 2),
+        'urls': len(set(urls))
+        }
+
+
+@click.command()
+@click.option('--files', type=int, default=20)
+@click.option('--size-mb', type=float, default=16)
+@click.option('--workers', type=int, default=4, help='Files uploaded at once.')
+@click.option('--max-concurrency', type=int, default=4, help='Threads per multipart upload.')
+@click.option('--threshold-mb', type=float, default=8, help='Multipart threshold.')
+@click.option('--chunk-mb', type=float, default=8, help='Multipart chunk size.')
+def main(files, size_mb, workers, max_concurrency, threshold_mb, chunk_mb):
+    results = benchmark(files, size_mb, workers, max_concurrency=max_concurrency,
+                        multipart_threshold_mb=threshold_mb, multipart_chunksize_mb=chunk_mb)
+    for k, v in results.items():
+        click.echo(f'{k}: {v}')
+
+
+if __name__ == '__main__':
+    main()
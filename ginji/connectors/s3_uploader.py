@@ -1,38 +1,64 @@
 import os
+from urllib.parse import quote
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
 from ginji.config import logger
 from ._base import BaseUploader
 
+MB = 1024 * 1024
+
 
 class S3Uploader(BaseUploader):
     config_name = 's3'
 
     def __init__(self):
         super(S3Uploader, self).__init__()
+        # one client for every upload thread; boto3 clients are thread-safe, and sharing it means
+        # sharing its connection pool too
         self.client = boto3.client('s3',
-                                   endpoint_url=self._config['host'])
+                                   endpoint_url=self._config['host'],
+                                   config=Config(
+                                       max_pool_connections=self._config['max_pool_connections']))
+        self.transfer_config = TransferConfig(
+            multipart_threshold=int(self._config['multipart_threshold_mb'] * MB),
+            multipart_chunksize=int(self._config['multipart_chunksize_mb'] * MB),
+            max_concurrency=self._config['max_concurrency'])
 
     def load_config(self):
         basic_config = super(S3Uploader, self).load_config()
         return {
             'host': basic_config.get('host', 'invalid-url'),
             'bucket': basic_config.get('bucket', ''),
-            'acl': basic_config.get('acl', 'public-read')
+            'acl': basic_config.get('acl', 'public-read'),
+            'public_url': basic_config.get('public_url', None),
+            'multipart_threshold_mb': basic_config.get('multipart_threshold_mb', 8),
+            'multipart_chunksize_mb': basic_config.get('multipart_chunksize_mb', 8),
+            'max_concurrency': basic_config.get('max_concurrency', 4),
+            'max_pool_connections': basic_config.get('max_pool_connections', 16)
             }
 
+    def url(self, key):
+        """
+        The public url of an object, worked out locally rather than asking S3 to sign one.
+
+        :param key: the object key
+        :return: str
+
+        """
+        base = self._config['public_url']
+        if base is None:
+            base = f'{self.client.meta.endpoint_url.rstrip("/")}/{self._config["bucket"]}'
+        return f'{base.rstrip("/")}/{quote(key)}'
+
     def run(self, file):
         _, filename = os.path.split(file)
-        try:
-            self.client.upload_file(file, self._config['bucket'], filename, ExtraArgs={
-                'ACL': self._config['acl']
-                })
-        except Exception as e:
-            logger.error(e)
-        media_url = self.client.generate_presigned_url('get_object', Params={
-            'Bucket': self._config['bucket'],
-            'Key': filename
-            }).split('?')[0]
+        # errors aren't caught here: a failed upload has no url, and the upload queue retries it
+        self.client.upload_file(file, self._config['bucket'], filename, ExtraArgs={
+            'ACL': self._config['acl']
+            }, Config=self.transfer_config)
+        media_url = self.url(filename)
         logger.debug(f'Uploaded {file} to S3 object store: {media_url}')
         return media_url
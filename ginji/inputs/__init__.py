@@ -1 +1,8 @@
-from .motion import MotionInput
+from ginji import registry
+
+
+def __getattr__(name):
+    # importing the motion input means importing picamera and opencv, so wait until it's wanted
+    if name == 'MotionInput':
+        return registry.load('inputs', 'motion')
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
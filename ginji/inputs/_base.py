@@ -1,6 +1,8 @@
 import threading
 from abc import ABC, abstractmethod
-from ginji.config import config
+from ginji.config import config, logger
+from ginji.metrics import stage
+from .bus import OutputWorker
 
 
 class BaseInput(ABC):
@@ -10,7 +12,9 @@ class BaseInput(ABC):
     def __init__(self):
         self._outputs = []
         self.cont = True
-        self.thread = threading.Thread(target=self.run)
+        # whatever stopped run(), if it didn't just finish
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
         self._config = self.load_config()
         self.setup()
 
@@ -23,20 +27,89 @@ class BaseInput(ABC):
         :param outputs: An Output instance with a compatible .fire() handler.
 
         """
-        self._outputs += outputs
+        self._outputs += [OutputWorker(o, self._config.get('queue_size', 4),
+                                       self._config.get('queue_policy', 'block')) for o in outputs]
 
-    def output(self, *args, **kwargs):
+    @property
+    def needs_frames(self):
+        """Whether any registered output needs the whole event's frames passed to it at the end."""
+        return any(not getattr(o.output, 'streaming', False) for o in self._outputs)
+
+    def open_streams(self, shape, fps):
+        """
+        Open a frame stream on every output that can take frames as they arrive.
+
+        :param shape: the shape of each frame
+        :param fps: the expected frame rate
+        :return: a dict of stream objects with .write(), .close() and .abort() methods, to be
+            passed back to output() when the event ends
+
+        """
+        return {o: o.output.open_stream(shape, fps) for o in self._outputs if
+                getattr(o.output, 'streaming', False)}
+
+    def output(self, *args, streams=None, **kwargs):
+        """
+        Queue an event for each output; the outputs fire on their own threads.
+
+        :param streams: streams from open_streams(); each streaming output gets its own stream in
+            place of the first argument
+
+        """
+        with stage('dispatch'):
+            if args and hasattr(args[0], 'hold'):
+                # a pooled buffer can be reused once every output that reads it is finished
+                args[0].hold(sum(1 for o in self._outputs if not (streams and o in streams)))
+            for o in self._outputs:
+                if streams and o in streams:
+                    o.put((streams[o],) + args[1:], kwargs)
+                else:
+                    o.put(args, kwargs)
+
+    def unpool(self):
+        """Get a pooled frame buffer back from the outputs, as their queue policies allow."""
+        return any([o.unpool() for o in self._outputs])
+
+    def preview(self, *args, **kwargs):
+        """
+        Give any output with a .poster() method an early look at an event, e.g. a single frame.
+        It's called straight away rather than queued behind earlier events, so it should return
+        quickly and do any slow work on a thread of its own.
+        """
         for o in self._outputs:
-            o.fire(*args, **kwargs)
+            if hasattr(o.output, 'poster'):
+                try:
+                    o.output.poster(*args, **kwargs)
+                except Exception as e:
+                    logger.error(f'{type(o.output).__name__} poster failed: {e}')
+
+    @property
+    def pending(self):
+        """The number of events queued or in progress across all outputs."""
+        return sum(o.depth + int(o.busy) for o in self._outputs)
+
+    def output_stats(self):
+        return {type(o.output).__name__: o.stats() for o in self._outputs}
+
+    def _run(self):
+        try:
+            self.run()
+        except Exception as e:
+            self.error = e
+            raise
 
     def start(self):
         self.cont = True
+        for o in self._outputs:
+            o.start()
         if not self.thread.is_alive():
             self.thread.start()
 
     def stop(self):
         self.cont = False
         self.thread.join()
+        for o in self._outputs:
+            o.stop()
 
     @abstractmethod
     def setup(self):
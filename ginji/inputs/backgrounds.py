@@ -0,0 +1,124 @@
+import os
+import pickle
+import threading
+import time
+
+import numpy as np
+
+from ginji.config import logger
+
+
+class BackgroundStore(object):
+    """
+    Saves snapshots of the background model as float32 .npy files. Writes happen on a worker
+    thread, at most once every interval seconds (the latest snapshot wins), and go to a temporary
+    file first so a crash can't leave a half-written background behind. Only the newest few
+    snapshots are kept.
+    """
+
+    def __init__(self, path, keep=3, interval=60):
+        self.path = path
+        self.keep = max(1, keep)
+        self.interval = interval
+        self._pending = None
+        self._last_write = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+        if not os.path.exists(self.path):
+            os.mkdir(self.path)
+
+    def _snapshots(self):
+        # names are millisecond timestamps, so they sort by age without stat-ing every file
+        return sorted(f for f in os.listdir(self.path) if f.startswith('bg_') and f.endswith('.npy'))
+
+    def load(self):
+        """
+        Load the most recent background that can be read, working back through the older
+        snapshots if the newest is damaged.
+
+        :return: a float32 array, or None if there isn't a saved background
+
+        """
+        snapshots = self._snapshots()
+        for snapshot in reversed(snapshots):
+            try:
+                background = np.array(np.load(os.path.join(self.path, snapshot), mmap_mode='r'), dtype=np.float32)
+                logger.debug('loaded background from ' + snapshot)
+                return background
+            except (OSError, ValueError) as e:
+                logger.error(f'could not load background from {snapshot}: {e}')
+        if snapshots:
+            return None
+        # fall back to the old pickled backgrounds
+        legacy = [f for f in os.listdir(self.path) if f.endswith('.pkl')]
+        if not legacy:
+            return None
+        latest = max(legacy, key=lambda x: os.path.getmtime(os.path.join(self.path, x)))
+        with open(os.path.join(self.path, latest), 'rb') as file:
+            background = pickle.load(file)
+        logger.debug('loaded background from ' + latest)
+        return None if background is None else np.asarray(background, dtype=np.float32)
+
+    def save(self, background):
+        """
+        Queue a snapshot of the background to be written.
+
+        :param background: the background array; it's copied, so it can carry on changing
+
+        """
+        with self._lock:
+            self._pending = np.array(background, dtype=np.float32)
+        # threads don't survive a fork, so (re)start the writer in whichever process this is
+        if self._thread is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='ginji-background', daemon=True)
+            self._thread.start()
+        self._wake.set()
+
+    def flush(self):
+        """Write any queued snapshot straight away."""
+        with self._lock:
+            pending, self._pending = self._pending, None
+        if pending is not None:
+            self._write(pending)
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            wait = self._last_write + self.interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            self.flush()
+
+    def _write(self, background):
+        name = f'bg_{int(time.time() * 1000):015d}.npy'
+        tmp = os.path.join(self.path, '.' + name)
+        with open(tmp, 'wb') as file:
+            np.save(file, background)
+            # make sure the data is on the card before the rename is, or a power cut can leave an
+            # empty file under the new name
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, os.path.join(self.path, name))
+        self._sync_dir()
+        self._last_write = time.time()
+        # prune old snapshots, and any pickled backgrounds now that there's a newer one
+        old = self._snapshots()[:-self.keep] + [f for f in os.listdir(self.path) if f.endswith('.pkl')]
+        for f in old:
+            os.remove(os.path.join(self.path, f))
+
+    def _sync_dir(self):
+        # so the rename itself survives a power cut; not every platform can open a directory
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
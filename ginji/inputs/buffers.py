@@ -0,0 +1,512 @@
+import os
+import queue
+import threading
+import time
+import weakref
+
+import cv2
+import numpy as np
+
+
+class FrameBuffer(object):
+    """
+    A fixed-capacity store for the frames of a single event, backed by one preallocated array.
+    While idle it only keeps the last few frames (the pre-trigger window); once triggered it
+    records until it's full, after which new frames are dropped rather than allocated.
+    If a spill directory is given, frames that don't fit are written to a preallocated memory-mapped
+    file there instead of being dropped, until that's full too.
+    """
+
+    def __init__(self, shape, capacity, pre_frames=0, dtype=np.uint8, spill_dir=None, spill_frames=0):
+        if capacity < 1:
+            raise ValueError('Frame buffer must hold at least one frame.')
+        self.shape = tuple(shape)
+        self.capacity = capacity
+        self.pre_frames = max(0, min(pre_frames, capacity - 1))
+        self._frames = self._allocate(capacity, dtype)
+        self._times = np.zeros(capacity, dtype=np.float64)
+        self._start = 0
+        self._count = 0
+        self.recording = False
+        self._triggered_at = 0
+        self.dropped = 0
+        self.stored = 0
+        self.store_time = 0
+        self.spill_dir = spill_dir
+        self.spill_frames = spill_frames if spill_dir is not None else 0
+        self._spill = None
+        self._spill_path = None
+        self._spill_times = None
+        self._spill_finalizer = None
+        self._spilled = 0
+        self.pool = None
+        self.holders = 0
+
+    @classmethod
+    def store_shape(cls, shape):
+        """The shape of a single frame as it's kept in the buffer."""
+        return tuple(shape)
+
+    @classmethod
+    def from_budget(cls, shape, budget_mb, pre_frames=0, dtype=np.uint8, **kwargs):
+        """
+        Create a buffer holding as many frames as will fit in the given memory budget.
+
+        :param shape: the shape of a single frame, e.g. (height, width, 3)
+        :param budget_mb: the memory budget in megabytes
+        :param pre_frames: the number of frames to keep from before the trigger
+        :param dtype: the frame dtype
+        :param kwargs: any other options for the buffer type
+        :return: FrameBuffer
+
+        """
+        frame_bytes = int(np.prod(cls.store_shape(shape))) * np.dtype(dtype).itemsize
+        capacity = max(1, int(budget_mb * 1024 * 1024) // frame_bytes)
+        return cls(shape, capacity, pre_frames, dtype, **kwargs)
+
+    def _allocate(self, capacity, dtype):
+        return np.empty((capacity,) + self.store_shape(self.shape), dtype=dtype)
+
+    @property
+    def nbytes(self):
+        """The memory set aside for frames."""
+        return self._frames.nbytes
+
+    @property
+    def stored_bytes(self):
+        """The memory taken up by the frames currently in the buffer."""
+        return self._count * self._frames[0].nbytes
+
+    @property
+    def spilled_bytes(self):
+        """The disk space taken up by frames that didn't fit in memory."""
+        if self._spilled == 0:
+            return 0
+        return self._spilled * self._spill[0].nbytes
+
+    @property
+    def store_cost(self):
+        """The average time spent storing each frame, in seconds."""
+        return self.store_time / self.stored if self.stored > 0 else 0
+
+    @property
+    def full(self):
+        return self._count == self.capacity
+
+    @property
+    def timestamps(self):
+        """The capture time of each stored frame, oldest first."""
+        timestamps = np.roll(self._times, -self._start)[:self._count]
+        if self._spilled > 0:
+            timestamps = np.concatenate((timestamps, self._spill_times[:self._spilled]))
+        return timestamps
+
+    @property
+    def fps(self):
+        """
+        The rate the stored frames were actually captured at, or None if there aren't enough
+        frames to tell. Once triggered, only the frames since count, since the pre-trigger window
+        may have been filled at the idle frame rate.
+        """
+        timestamps = self.timestamps
+        if len(timestamps) - self._triggered_at >= 2:
+            timestamps = timestamps[self._triggered_at:]
+        if len(timestamps) < 2:
+            return None
+        span = timestamps[-1] - timestamps[0]
+        if span <= 0:
+            return None
+        return (len(timestamps) - 1) / span
+
+    def _slot(self, ix):
+        return (self._start + ix) % self.capacity
+
+    def _store(self, dst, frame):
+        np.copyto(dst, frame)
+
+    def _load(self, stored):
+        return stored
+
+    def _write(self, slot, frame):
+        self._store(self._frames[slot], frame)
+
+    def _read(self, slot):
+        return self._load(self._frames[slot])
+
+    def _open_spill(self):
+        if not os.path.exists(self.spill_dir):
+            os.makedirs(self.spill_dir)
+        self._spill_path = os.path.join(self.spill_dir, f'frames_{time.time():.6f}.dat')
+        self._spill = np.memmap(self._spill_path, dtype=self._frames.dtype, mode='w+',
+                                shape=(self.spill_frames,) + self.store_shape(self.shape))
+        self._spill_times = np.zeros(self.spill_frames, dtype=np.float64)
+        self._spill_finalizer = weakref.finalize(self, _remove, self._spill_path)
+
+    def release(self):
+        """Delete the spill file, if there is one. The spilled frames are gone after this."""
+        if self._spill_finalizer is not None:
+            self._spill = None
+            self._spill_finalizer()
+        self._spill_path = None
+        self._spill_times = None
+        self._spill_finalizer = None
+        self._spilled = 0
+
+    def _discard(self, slot):
+        pass
+
+    def _add_time(self, seconds):
+        self.store_time += seconds
+
+    def _ordered(self):
+        """The stored frames (as stored, not decoded), oldest first."""
+        end = self._start + self._count
+        if end <= self.capacity:
+            return self._frames[self._start:end]
+        return np.concatenate((self._frames[self._start:], self._frames[:end - self.capacity]))
+
+    def add(self, frame, timestamp=0.0):
+        """
+        Copy a frame into the next free slot.
+
+        :param frame: an array with the same shape as the buffer's frames
+        :param timestamp: the time the frame was captured, in seconds
+        :return: True if the frame was stored, False if it was dropped
+
+        """
+        if not self.recording:
+            if self.pre_frames == 0:
+                return False
+            if self._count == self.pre_frames:
+                # discard the oldest pre-trigger frame
+                self._discard(self._start)
+                self._start = self._slot(1)
+                self._count -= 1
+        elif self.full:
+            if self._spilled < self.spill_frames:
+                return self._add_spill(frame, timestamp)
+            self.dropped += 1
+            return False
+        slot = self._slot(self._count)
+        start = time.perf_counter()
+        self._write(slot, frame)
+        self._add_time(time.perf_counter() - start)
+        self.stored += 1
+        self._times[slot] = timestamp
+        self._count += 1
+        return True
+
+    def _add_spill(self, frame, timestamp):
+        if self._spill is None:
+            self._open_spill()
+        start = time.perf_counter()
+        self._store(self._spill[self._spilled], frame)
+        self._add_time(time.perf_counter() - start)
+        self.stored += 1
+        self._spill_times[self._spilled] = timestamp
+        self._spilled += 1
+        return True
+
+    def __getstate__(self):
+        # only pickle the frames that are actually in use; spilled frames stay in their file,
+        # which now belongs to whoever unpickles this
+        state = self.__dict__.copy()
+        state['_frames'] = self._ordered()
+        state['_times'] = np.roll(self._times, -self._start)[:self._count]
+        state['_start'] = 0
+        state['capacity'] = max(1, self._count)
+        state['_spill'] = None
+        state['_spill_finalizer'] = None
+        state['pool'] = None
+        if self._spill_finalizer is not None:
+            self._spill.flush()
+            self._spill_finalizer.detach()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if len(self._frames) == 0:
+            self._frames = self._allocate(1, self._frames.dtype)
+            self._times = np.zeros(1, dtype=np.float64)
+        if self._spill_path is not None:
+            self._spill = np.memmap(self._spill_path, dtype=self._frames.dtype, mode='r+',
+                                    shape=(self.spill_frames,) + self.store_shape(self.shape))
+            self._spill_finalizer = weakref.finalize(self, _remove, self._spill_path)
+
+    def hold(self, holders):
+        """
+        Lend the buffer to some outputs; it goes back to its pool once they've all called done().
+
+        :param holders: how many outputs it's been given to
+
+        """
+        if self.pool is not None:
+            self.pool.lend(self, holders)
+
+    def done(self):
+        """Called by each output once it's finished with the frames."""
+        if self.pool is not None:
+            self.pool.done(self)
+
+    def trigger(self):
+        """Start recording, keeping whatever is currently in the pre-trigger window."""
+        self.recording = True
+        self._triggered_at = len(self)
+
+    def reset(self):
+        """Discard all frames and return to the idle state."""
+        self._start = 0
+        self._count = 0
+        self.recording = False
+        self._triggered_at = 0
+        self.dropped = 0
+        self.stored = 0
+        self.store_time = 0
+        self.release()
+
+    def __len__(self):
+        return self._count + self._spilled
+
+    def __getitem__(self, ix):
+        if ix < 0:
+            ix += len(self)
+        if not 0 <= ix < len(self):
+            raise IndexError('frame index out of range')
+        if ix >= self._count:
+            return self._load(self._spill[ix - self._count])
+        return self._read(self._slot(ix))
+
+    def items(self):
+        """
+        Iterate over the stored frames along with their timestamps.
+
+        :return: a generator of (frame, timestamp) tuples
+
+        """
+        for ix in range(self._count):
+            slot = self._slot(ix)
+            yield self._read(slot), self._times[slot]
+        for ix in range(self._spilled):
+            yield self._load(self._spill[ix]), self._spill_times[ix]
+
+    def __iter__(self):
+        for frame, _ in self.items():
+            yield frame
+
+
+class YUVFrameBuffer(FrameBuffer):
+    """
+    Keeps frames as YUV420 planes, half the size of BGR. Frames are converted back to BGR when
+    they're read. Frame width and height have to be even.
+    """
+
+    @classmethod
+    def store_shape(cls, shape):
+        height, width = shape[:2]
+        return height * 3 // 2, width
+
+    def _store(self, dst, frame):
+        cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420, dst=dst)
+
+    def _load(self, stored):
+        return cv2.cvtColor(stored, cv2.COLOR_YUV2BGR_I420)
+
+
+class JPEGFrameBuffer(FrameBuffer):
+    """
+    Keeps frames as JPEGs, encoded on a worker thread so capture doesn't wait for them.
+    Frames are copied into a small preallocated staging area for the worker; if that's full, the
+    frame is encoded straight away instead. Since JPEG sizes vary, the buffer is full when either
+    the frame count or the byte budget runs out.
+    """
+
+    def __init__(self, shape, capacity, pre_frames=0, dtype=np.uint8, budget=None, quality=90,
+                 staging=4):
+        self.budget = budget
+        self.quality = quality
+        self._staging = np.empty((staging,) + tuple(shape), dtype=dtype)
+        self._free = queue.Queue()
+        for ix in range(staging):
+            self._free.put(ix)
+        self._jobs = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._bytes = 0
+        self._sizes = np.zeros(capacity, dtype=np.int64)
+        self._generations = np.zeros(capacity, dtype=np.int64)
+        super(JPEGFrameBuffer, self).__init__(shape, capacity, pre_frames, dtype)
+
+    @classmethod
+    def from_budget(cls, shape, budget_mb, pre_frames=0, dtype=np.uint8, quality=90):
+        # assume at least 4:1 compression to size the slots; the byte budget is the real limit
+        frame_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        budget = int(budget_mb * 1024 * 1024)
+        capacity = max(1, 4 * budget // frame_bytes)
+        return cls(shape, capacity, pre_frames, dtype, budget=budget, quality=quality)
+
+    def _allocate(self, capacity, dtype):
+        return [None] * capacity
+
+    @property
+    def nbytes(self):
+        return self._staging.nbytes + (self.budget or self._bytes)
+
+    @property
+    def stored_bytes(self):
+        self._jobs.join()
+        return self._bytes
+
+    @property
+    def full(self):
+        return self._count == self.capacity or (self.budget is not None and self._bytes >= self.budget)
+
+    def _add_time(self, seconds):
+        with self._lock:
+            self.store_time += seconds
+
+    def _encode(self, slot, generation, frame):
+        start = time.perf_counter()
+        encoded = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])[1].tobytes()
+        self._add_time(time.perf_counter() - start)
+        with self._lock:
+            # the slot might have been discarded or reused while we were encoding
+            if self._generations[slot] != generation:
+                return
+            self._frames[slot] = encoded
+            self._sizes[slot] = len(encoded)
+            self._bytes += len(encoded)
+
+    def _work(self):
+        while True:
+            slot, generation, ix = self._jobs.get()
+            self._encode(slot, generation, self._staging[ix])
+            self._free.put(ix)
+            self._jobs.task_done()
+
+    def _write(self, slot, frame):
+        self._discard(slot)
+        generation = self._generations[slot]
+        try:
+            ix = self._free.get_nowait()
+        except queue.Empty:
+            self._encode(slot, generation, frame)
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work, name='ginji-jpeg', daemon=True)
+            self._thread.start()
+        np.copyto(self._staging[ix], frame)
+        self._jobs.put((slot, generation, ix))
+
+    def _read(self, slot):
+        self._jobs.join()
+        return cv2.imdecode(np.frombuffer(self._frames[slot], np.uint8), cv2.IMREAD_COLOR)
+
+    def _discard(self, slot):
+        with self._lock:
+            self._generations[slot] += 1
+            self._bytes -= self._sizes[slot]
+            self._sizes[slot] = 0
+            self._frames[slot] = None
+
+    def _ordered(self):
+        self._jobs.join()
+        return [self._frames[self._slot(ix)] for ix in range(self._count)]
+
+    def __getstate__(self):
+        state = super(JPEGFrameBuffer, self).__getstate__()
+        state['_sizes'] = np.array([len(f) for f in state['_frames']], dtype=np.int64)
+        state['_generations'] = np.zeros(len(state['_frames']), dtype=np.int64)
+        state['_staging'] = self._staging[:0]
+        for k in ('_free', '_jobs', '_lock', '_thread'):
+            del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if len(self._frames) == 0:
+            self._frames = [None]
+            self._times = np.zeros(1, dtype=np.float64)
+        self._free = queue.Queue()
+        self._jobs = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def reset(self):
+        self._jobs.join()
+        for ix in range(self._count):
+            self._discard(self._slot(ix))
+        super(JPEGFrameBuffer, self).reset()
+
+
+class BufferPool(object):
+    """
+    A few preallocated event buffers that take turns: one records while the others are with the
+    outputs, so the outputs can read the frames in place instead of from a copy. The memory budget
+    is shared between all of them.
+    """
+
+    def __init__(self, buffers):
+        self.buffers = list(buffers)
+        self._free = queue.Queue()
+        self._lock = threading.Lock()
+        for b in self.buffers:
+            b.pool = self
+            self._free.put(b)
+
+    @classmethod
+    def from_budget(cls, store, count, shape, budget_mb, pre_frames=0, **kwargs):
+        """
+        :param store: the buffer class, e.g. FrameBuffer
+        :param count: how many buffers to make
+        :param budget_mb: the memory budget for all of them together
+        :return: BufferPool
+
+        """
+        count = max(1, count)
+        return cls(store.from_budget(shape, budget_mb / count, pre_frames, **kwargs) for _ in range(count))
+
+    @property
+    def nbytes(self):
+        return sum(b.nbytes for b in self.buffers)
+
+    @property
+    def free(self):
+        return self._free.qsize()
+
+    def get(self, block=True):
+        """
+        :param block: wait for a buffer to come back if they're all in use
+        :return: an empty buffer, or None if there isn't one and block is False
+
+        """
+        try:
+            buffer = self._free.get(block)
+        except queue.Empty:
+            return None
+        buffer.reset()
+        return buffer
+
+    def lend(self, buffer, holders):
+        with self._lock:
+            buffer.holders = holders
+        if holders == 0:
+            self._free.put(buffer)
+
+    def done(self, buffer):
+        with self._lock:
+            buffer.holders -= 1
+            finished = buffer.holders == 0
+        if finished:
+            self._free.put(buffer)
+
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+frame_stores = {
+    'raw': FrameBuffer,
+    'yuv420': YUVFrameBuffer,
+    'jpeg': JPEGFrameBuffer
+    }
@@ -0,0 +1,196 @@
+import collections
+import os
+import pickle
+import queue
+import threading
+import time
+
+from ginji.config import config, logger
+from ginji.metrics import registry
+
+POLICIES = ('block', 'drop_oldest', 'spill')
+
+
+class OutputWorker(object):
+    """
+    Fires a single output on its own thread, fed by a bounded queue.
+    When the queue is full, the policy decides what happens to new events:
+        block: wait for space (the caller stalls)
+        drop_oldest: throw away the oldest queued event
+        spill: pickle the event to disk and pick it up again once the queue has caught up
+    """
+
+    def __init__(self, output, maxsize=4, policy='block'):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown queue policy "{policy}"; use one of {", ".join(POLICIES)}.')
+        self.output = output
+        self.policy = policy
+        self.queue = queue.Queue(maxsize)
+        self.thread = threading.Thread(target=self.run, name=f'ginji-{type(output).__name__}',
+                                       daemon=True)
+        self.cont = True
+        self.busy = False
+        self.processed = 0
+        self.dropped = 0
+        self.lag = 0
+        self.max_lag = 0
+        self._lock = threading.Lock()
+        self._spilled = collections.deque()
+        self.spill_dir = os.path.join(config.root, 'spill', type(output).__name__)
+        if policy == 'spill':
+            self._load_spilled()
+        name = type(output).__name__
+        registry.gauge('ginji_output_queue_depth', 'Events waiting for each output.', fn=lambda: self.depth,
+                       output=name)
+        self._fire_time = registry.histogram('ginji_output_seconds', 'Time taken to fire each output.',
+                                             output=name)
+        self._lag = registry.histogram('ginji_output_lag_seconds', 'Time events spent queued for each output.',
+                                       output=name)
+        self._dropped = registry.counter('ginji_dropped_events_total', 'Events dropped by full output queues.',
+                                         output=name)
+
+    def _load_spilled(self):
+        if not os.path.exists(self.spill_dir):
+            os.makedirs(self.spill_dir)
+        leftovers = sorted(f for f in os.listdir(self.spill_dir) if f.endswith('.pkl'))
+        self._spilled.extend(os.path.join(self.spill_dir, f) for f in leftovers)
+        if leftovers:
+            logger.debug(f'Found {len(leftovers)} spilled events for {type(self.output).__name__}.')
+
+    @property
+    def depth(self):
+        return self.queue.qsize() + len(self._spilled)
+
+    def put(self, args, kwargs):
+        event = (time.time(), args, kwargs)
+        if self.policy == 'block':
+            self.queue.put(event)
+        elif self.policy == 'drop_oldest':
+            while True:
+                try:
+                    self.queue.put_nowait(event)
+                    break
+                except queue.Full:
+                    try:
+                        self._done(self.queue.get_nowait())
+                        self.dropped += 1
+                        self._dropped.inc()
+                        logger.debug(f'{type(self.output).__name__} queue full, dropped oldest event')
+                    except queue.Empty:
+                        pass
+        else:
+            with self._lock:
+                # once anything has spilled, keep spilling until it's drained so events stay in order
+                if not self._spilled:
+                    try:
+                        self.queue.put_nowait(event)
+                        return
+                    except queue.Full:
+                        pass
+                self._spill(event)
+
+    def _spill(self, event, reason='queue full'):
+        fn = os.path.join(self.spill_dir, f'{event[0]:.6f}.pkl')
+        with open(fn, 'wb') as file:
+            pickle.dump(event, file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._spilled.append(fn)
+        # the pickle has its own copy of the frames
+        self._done(event)
+        logger.debug(f'{type(self.output).__name__} {reason}, spilled event to {fn}')
+
+    def unpool(self):
+        """
+        Called when the input has lent out all of its pooled frame buffers: the newest queued
+        event lets go of its buffer, so events queue up (and spill, or drop the oldest) as they
+        would if they had frames of their own. Under spill it goes to disk; under drop_oldest it
+        keeps a copy of its frames. Under block, the input waits for a buffer instead.
+
+        :return: True if an event let go of a buffer
+
+        """
+        if self.policy == 'block':
+            return False
+        with self._lock:
+            with self.queue.mutex:
+                queued = self.queue.queue
+                if not queued or not any(hasattr(arg, 'done') for arg in queued[-1][1]):
+                    return False
+                if self.policy == 'spill':
+                    # it's the newest, so spilling it keeps everything in order
+                    event = queued.pop()
+                    self.queue.not_full.notify()
+                else:
+                    event = queued[-1]
+                    # a pickled copy doesn't belong to the pool
+                    queued[-1] = pickle.loads(pickle.dumps(event, protocol=pickle.HIGHEST_PROTOCOL))
+            if self.policy == 'spill':
+                self._spill(event, 'out of frame buffers')
+            else:
+                self._done(event)
+                logger.debug(f'{type(self.output).__name__} out of frame buffers, copied newest event')
+        return True
+
+    @staticmethod
+    def _done(event):
+        # let pooled frame buffers be reused
+        for arg in event[1]:
+            if hasattr(arg, 'done'):
+                arg.done()
+
+    def _next(self):
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._spilled:
+                fn = self._spilled.popleft()
+                with open(fn, 'rb') as file:
+                    event = pickle.load(file)
+                os.remove(fn)
+                return event
+        try:
+            return self.queue.get(timeout=0.5)
+        except queue.Empty:
+            return None
+
+    def run(self):
+        # keep going after stop() until everything queued has been handled
+        while self.cont or self.depth > 0:
+            event = self._next()
+            if event is None:
+                continue
+            queued_at, args, kwargs = event
+            self.busy = True
+            self.lag = time.time() - queued_at
+            self.max_lag = max(self.max_lag, self.lag)
+            self._lag.observe(self.lag)
+            try:
+                with self._fire_time.time():
+                    self.output.fire(*args, **kwargs)
+            except Exception as e:
+                logger.error(f'{type(self.output).__name__} failed: {e}')
+            self._done(event)
+            self.busy = False
+            self.processed += 1
+            logger.debug(f'{type(self.output).__name__}: {self.stats()}')
+
+    def start(self):
+        self.cont = True
+        if not self.thread.is_alive():
+            self.thread.start()
+
+    def stop(self):
+        self.cont = False
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'busy': self.busy,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'lag': round(self.lag, 3),
+            'max_lag': round(self.max_lag, 3)
+            }
@@ -0,0 +1,143 @@
+from abc import ABC, abstractmethod
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from ginji.metrics import stage
+
+Detection = namedtuple('Detection', ['motion', 'areas', 'centroids'])
+Detection.__doc__ = """
+The result of looking for motion in one frame.
+
+:param motion: True if anything big enough moved
+:param areas: an array of the area of each moving region, in analysis pixels
+:param centroids: an (n, 2) array of the (x, y) centre of each moving region
+"""
+
+NO_MOTION = Detection(False, np.empty(0), np.empty((0, 2)))
+
+
+class BaseDetector(ABC):
+    """Finds moving regions in a sequence of blurred greyscale frames."""
+
+    config_name = 'base'
+    # whether .background is the whole model, so it's worth saving and loading
+    saves_background = True
+
+    def __init__(self, min_area, dilate_iterations, threshold=20):
+        self.min_area = min_area
+        self.dilate_iterations = dilate_iterations
+        self.threshold = threshold
+        self.background = None
+
+    @abstractmethod
+    def detect(self, imgrey):
+        """
+        Look for motion in a frame, updating the background model.
+
+        :param imgrey: a blurred greyscale frame
+        :return: a Detection, or None if the frame was only used to initialise the background
+
+        """
+        pass
+
+    def _regions(self, mask):
+        # one vectorised pass over the mask instead of a python loop over contours
+        with stage('contours'):
+            n, _, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+            areas = stats[1:n, cv2.CC_STAT_AREA]
+            keep = areas >= self.min_area
+            areas = areas[keep]
+        return Detection(len(areas) > 0, areas, centroids[1:n][keep])
+
+    def _accumulate(self, imgrey):
+        """
+        Update a running-average background and threshold the difference from it.
+
+        :return: the dilated threshold mask, or None if the background was (re)initialised
+
+        """
+        if self.background is None or self.background.shape != imgrey.shape:
+            self.background = imgrey.astype(np.float32)
+            return None
+        with stage('background'):
+            cv2.accumulateWeighted(imgrey, self.background, 0.5)
+        with stage('threshold'):
+            frame_delta = cv2.absdiff(imgrey, cv2.convertScaleAbs(self.background))
+            frame_threshold = cv2.threshold(frame_delta, self.threshold, 255, cv2.THRESH_BINARY)[1]
+            return cv2.dilate(frame_threshold, None, iterations=self.dilate_iterations)
+
+
+class ContourDetector(BaseDetector):
+    """The original detector: running-average background and contours."""
+
+    config_name = 'contours'
+
+    def detect(self, imgrey):
+        frame_dilated = self._accumulate(imgrey)
+        if frame_dilated is None:
+            return None
+        with stage('contours'):
+            contours, hier = cv2.findContours(frame_dilated, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+
+            areas = []
+            centroids = []
+            for c in contours:
+                area = cv2.contourArea(c)
+                if area < self.min_area:
+                    continue
+                m = cv2.moments(c)
+                areas.append(area)
+                centroids.append((m['m10'] / m['m00'], m['m01'] / m['m00']))
+        return Detection(len(areas) > 0, np.array(areas), np.array(centroids).reshape(-1, 2))
+
+
+class ComponentsDetector(BaseDetector):
+    """Running-average background, with connected components in place of contours."""
+
+    config_name = 'components'
+
+    def detect(self, imgrey):
+        frame_dilated = self._accumulate(imgrey)
+        if frame_dilated is None:
+            return None
+        return self._regions(frame_dilated)
+
+
+class MOG2Detector(BaseDetector):
+    """OpenCV's Gaussian mixture background subtractor; it keeps its own background model."""
+
+    config_name = 'mog2'
+    saves_background = False
+
+    def __init__(self, min_area, dilate_iterations, threshold=20):
+        super(MOG2Detector, self).__init__(min_area, dilate_iterations, threshold)
+        self.subtractor = self.make_subtractor()
+        self._learning = True
+
+    def make_subtractor(self):
+        return cv2.createBackgroundSubtractorMOG2(detectShadows=False)
+
+    def detect(self, imgrey):
+        with stage('background'):
+            mask = self.subtractor.apply(imgrey)
+        if self._learning:
+            # everything is foreground in the very first frame
+            self._learning = False
+            return None
+        with stage('threshold'):
+            mask = cv2.dilate(mask, None, iterations=self.dilate_iterations)
+        return self._regions(mask)
+
+
+class KNNDetector(MOG2Detector):
+    """OpenCV's k-nearest-neighbours background subtractor."""
+
+    config_name = 'knn'
+
+    def make_subtractor(self):
+        return cv2.createBackgroundSubtractorKNN(detectShadows=False)
+
+
+detectors = {d.config_name: d for d in [ContourDetector, ComponentsDetector, MOG2Detector, KNNDetector]}
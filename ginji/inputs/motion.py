@@ -1,26 +1,43 @@
+import multiprocessing as mp
 import os
-import pickle
+import queue
+import signal
 import time
-from datetime import datetime as dt
 import numpy as np
-import math
 import cv2
-import picamera
-from picamera.array import PiRGBArray
 
 from ginji.config import config, logger
+from ginji.metrics import registry, stage
 from ._base import BaseInput
+from .backgrounds import BackgroundStore
+from .buffers import BufferPool, FrameBuffer, JPEGFrameBuffer, frame_stores
+from .detectors import NO_MOTION, detectors
+from .recording import CircularRecorder
+from .shared import SharedFrameRing
+from .sources import sources
 
 
 class MotionInput(BaseInput):
     config_name = 'motion'
 
     def __init__(self):
-        self.cam = picamera.PiCamera()
-        self.background = None
-        self.bgfile = None
+        self.source = None
+        self.detector = None
+        self.bg_store = None
         self.cont = True
         self._motion = False
+        self._bg_request = None
+        self._bg_worker = False
+        self.recorder = None
+        self.dropped_frames = 0
+        # shared so that detector processes can see it too
+        self._event_active = mp.Value('b', 0, lock=False)
+        self._fast = mp.Value('b', 1, lock=False)
+        self._rate_fast = None
+        self._gate_tiles = None
+        self._gate_frames = 0
+        self._gate_passed = 0
+        self._gate_time = 0
         super(MotionInput, self).__init__()
 
     def load_config(self):
@@ -28,124 +45,561 @@ class MotionInput(BaseInput):
         return {
             'height': basic_config.get('height', 480),
             'width': basic_config.get('width', 640),
+            'analysis_width': basic_config.get('analysis_width', basic_config.get('width', 640)),
+            'analysis_height': basic_config.get('analysis_height', basic_config.get('height', 480)),
+            'framerate': basic_config.get('framerate', 30),
+            'source': basic_config.get('source', 'picamera'),
+            'source_options': basic_config.get('source_options', {}),
+            'idle_framerate': basic_config.get('idle_framerate', None),
+            'recording': basic_config.get('recording', 'raw'),
+            'record_width': basic_config.get('record_width', basic_config.get('width', 640)),
+            'record_height': basic_config.get('record_height', basic_config.get('height', 480)),
+            'preroll_seconds': basic_config.get('preroll_seconds', 3),
+            'bitrate': basic_config.get('bitrate', 17000000),
             'crop_top': basic_config.get('crop_top', 0),
             'crop_bottom': 1 - basic_config.get('crop_bottom', 0),
             'crop_left': basic_config.get('crop_left', 0),
             'crop_right': 1 - basic_config.get('crop_right', 0),
             'min_moving_frames': basic_config.get('min_moving_frames', 5),
             'min_area': basic_config.get('min_area', 5000),
-            'max_silent_frames': basic_config.get('max_silent_frames', 20)
+            'detector': basic_config.get('detector', 'contours'),
+            'bg_keep': basic_config.get('bg_keep', 3),
+            'bg_interval': basic_config.get('bg_interval', 60),
+            'gate_threshold': basic_config.get('gate_threshold', 0),
+            'gate_tile': basic_config.get('gate_tile', 16),
+            'gate_refresh': basic_config.get('gate_refresh', 25),
+            'gate_report': basic_config.get('gate_report', 1000),
+            'max_silent_frames': basic_config.get('max_silent_frames', 20),
+            'poster_seconds': basic_config.get('poster_seconds', 1.0),
+            'buffer_mb': basic_config.get('buffer_mb', 128),
+            'buffers': basic_config.get('buffers', 2),
+            'pre_frames': basic_config.get('pre_frames', 0),
+            'frame_store': basic_config.get('frame_store', 'raw'),
+            'jpeg_quality': basic_config.get('jpeg_quality', 90),
+            'spill_mb': basic_config.get('spill_mb', 0),
+            'processes': basic_config.get('processes', 0),
+            'stall_seconds': basic_config.get('stall_seconds', 5),
+            'ring_frames': basic_config.get('ring_frames', 16),
+            'queue_size': basic_config.get('queue_size', 4),
+            'queue_policy': basic_config.get('queue_policy', 'block')
             }
 
     def setup(self):
-        bg_path = os.path.join(config.root, 'backgrounds')
-        if not os.path.exists(bg_path):
-            os.mkdir(bg_path)
-            self.bgfile = os.path.join(bg_path, 'bg1.pkl')
-        else:
-            bgfiles = os.listdir(bg_path)
-            bgfiles = sorted(bgfiles, key=lambda x: os.path.getmtime(os.path.join(bg_path, x)))
-
-            # load the most recent bg file
-            with open(os.path.join(bg_path, bgfiles[-1]), 'rb') as file:
-                self.background = pickle.load(file)
-            logger.debug('loaded background from ' + bgfiles[-1])
-
-            # now make a new file
-            ix = int(bgfiles[-1].split('.')[0].replace('bg', '')) + 1
-            fn = os.path.join(bg_path, f'bg{ix}.pkl')
-            while os.path.exists(fn):
-                ix += 1
-                fn = os.path.join(bg_path, f'bg{ix}.pkl')
-            self.bgfile = fn
+        # work out the crop and detection parameters once, from the real frame size
+        width, height = self._config['width'], self._config['height']
+        self._roi = (slice(int(height * self._config['crop_top']), int(height * self._config['crop_bottom'])),
+                     slice(int(width * self._config['crop_left']), int(width * self._config['crop_right'])))
+        scale_x = self._config['analysis_width'] / width
+        scale_y = self._config['analysis_height'] / height
+        roi_height = self._roi[0].stop - self._roi[0].start
+        roi_width = self._roi[1].stop - self._roi[1].start
+        self._analysis_size = (max(1, round(roi_width * scale_x)), max(1, round(roi_height * scale_y)))
+        # blur, dilation and min_area are given for full-size frames; scale them so the same size
+        # of cat still counts
+        scale = (scale_x + scale_y) / 2
+        blur = max(3, int(round(21 * scale)) | 1)
+        self._blur = (blur, blur)
+        self._dilate_iterations = max(1, int(round(10 * scale)))
+        self._min_area = self._config['min_area'] * scale_x * scale_y
+        if (scale_x, scale_y) != (1, 1):
+            logger.debug(f'analysing at {self._analysis_size[0]}x{self._analysis_size[1]}, blur {blur}, '
+                         f'dilate x{self._dilate_iterations}, min area {self._min_area:.0f}')
+        self.detector = detectors[self._config['detector']](self._min_area, self._dilate_iterations)
+
+        self.bg_store = BackgroundStore(os.path.join(config.root, 'backgrounds'),
+                                        self._config['bg_keep'], self._config['bg_interval'])
+        if self.detector.saves_background:
+            self.background = self.bg_store.load()
+
+    @property
+    def h264(self):
+        return self._config['recording'] == 'h264'
+
+    def open_source(self):
+        options = dict(self._config['source_options'])
+        if self.h264:
+            if self._config['source'] != 'picamera':
+                raise ValueError('h264 recording needs the picamera source.')
+            options['resolution'] = (self._config['record_width'], self._config['record_height'])
+        self.source = sources[self._config['source']](self._config['width'], self._config['height'],
+                                                      self._config['framerate'], **options)
+        self.source.open()
+        self._rate_fast = None
+
+    def set_active(self, active):
+        """
+        Switch between full frame rate and idle frame rate. The capture loop picks up the change
+        on its next frame, whichever process it's in.
+
+        :param active: True for full speed
+
+        """
+        # in h264 mode the recording shares the sensor's frame rate, so leave it alone
+        if self._config['idle_framerate'] and not self.h264:
+            self._fast.value = int(active)
+
+    def _apply_rate(self):
+        fast = bool(self._fast.value)
+        if not self._config['idle_framerate'] or self.h264 or fast == self._rate_fast:
+            return
+        self.source.set_framerate(self._config['framerate'] if fast else self._config['idle_framerate'])
+        self._rate_fast = fast
+        logger.debug(f'capturing at {"full" if fast else "idle"} frame rate')
+
+    def detect(self, frame):
+        """
+        Look for motion in a single frame, updating the background as it goes.
+
+        :param frame: a full BGR frame
+        :return: a Detection, or None if the frame was only used to initialise the background
+
+        """
+        with stage('grey'):
+            imgrey = cv2.cvtColor(frame[self._roi], cv2.COLOR_BGR2GRAY)
+            if imgrey.shape[::-1] != self._analysis_size:
+                imgrey = cv2.resize(imgrey, self._analysis_size, interpolation=cv2.INTER_AREA)
+        if self._config['gate_threshold'] > 0 and not self._event_active.value:
+            start = time.time()
+            with stage('gate'):
+                passed = self.gate(imgrey)
+            if not passed:
+                self._gate_time += time.time() - start
+            self._report_gate()
+            if not passed:
+                return NO_MOTION
+        with stage('blur'):
+            imgrey = cv2.GaussianBlur(imgrey, self._blur, 0)
+        detection = self.detector.detect(imgrey)
+        if detection is None:
             self.save_bg()
+            logger.debug('initialised background')
+        return detection
+
+    def gate(self, imgrey):
+        """
+        A cheap first check for idle frames: compare the mean of each tile against a running
+        average, and only bother with the full detector if one of them has changed enough.
+        Every so often a frame is let through anyway so the detector's background keeps up.
+
+        :param imgrey: a greyscale frame at analysis resolution
+        :return: True if the frame should go through the full detector
+
+        """
+        height, width = imgrey.shape
+        t = max(1, min(self._config['gate_tile'], height, width))
+        tiles = imgrey[:height - height % t, :width - width % t].reshape(
+            height // t, t, width // t, t).mean(axis=(1, 3))
+        self._gate_frames += 1
+        if self._gate_tiles is None or self._gate_tiles.shape != tiles.shape:
+            self._gate_tiles = tiles
+            passed = True
+        else:
+            score = np.abs(tiles - self._gate_tiles).max()
+            self._gate_tiles += 0.5 * (tiles - self._gate_tiles)
+            tripped = score >= self._config['gate_threshold']
+            if tripped:
+                # don't wait for the detector before speeding up
+                self.set_active(True)
+            passed = tripped or self._gate_frames % self._config['gate_refresh'] == 0
+        if passed:
+            self._gate_passed += 1
+        return passed
+
+    def _report_gate(self):
+        skipped = self._gate_frames - self._gate_passed
+        if self._gate_frames % self._config['gate_report'] != 0 or skipped == 0:
+            return
+        logger.debug(f'gate passed {self._gate_passed / self._gate_frames:.1%} of {self._gate_frames} idle '
+                     f'frames; skipped frames took {1000 * self._gate_time / skipped:.2f}ms each '
+                     f'({skipped / max(self._gate_time, 1e-9):.0f} fps)')
+
+    @property
+    def background(self):
+        return self.detector.background
+
+    @background.setter
+    def background(self, value):
+        self.detector.background = value
+
+    def frames(self):
+        """
+        Capture and analyse frames.
+
+        :return: a generator of (frame, timestamp, Detection) tuples
+
+        """
+        # the recorder has to be split from the thread that owns the camera, so h264 mode always
+        # captures here
+        if self._config['processes'] > 0 and not self.h264:
+            yield from self._frames_parallel(self._config['processes'])
+            return
+        self.open_source()
+        capture_options = {}
+        if self.h264:
+            self.recorder = CircularRecorder(self.source.camera, os.path.join(config.root, 'recordings'),
+                                             self._config['preroll_seconds'], self._config['bitrate'])
+            self.recorder.start()
+            # detect on a second splitter port, scaled down by the GPU
+            capture_options = {
+                'splitter_port': 2,
+                'resize': self.source.size
+                }
+        capture_wait = registry.histogram('ginji_stage_seconds', stage='capture_wait')
+        try:
+            waiting = time.perf_counter()
+            for frame, timestamp in self.source.frames(**capture_options):
+                capture_wait.observe(time.perf_counter() - waiting)
+                self._apply_rate()
+                yield frame, timestamp, self.detect(frame)
+                waiting = time.perf_counter()
+        finally:
+            if self.recorder is not None:
+                self.recorder.stop()
+                self.recorder = None
+            self.source.close()
+            logger.debug('source closed')
+
+    def _frames_parallel(self, n_detectors):
+        """
+        Capture in one process and detect in n_detectors others, passing frames through a shared
+        memory ring. Each detector takes every nth frame and keeps its own background.
+        Results are put back into capture order here; frames that were overwritten before anyone
+        got to them, or whose result never turned up, are counted as dropped. If any of the
+        processes fails, so does this.
+        """
+        # spawned rather than forked: by now the outputs, uploads and metrics all have threads of
+        # their own, and forking a process full of threads is asking for trouble
+        ctx = mp.get_context('spawn')
+        shape = (self._config['height'], self._config['width'], 3)
+        ring = SharedFrameRing(shape, self._config['ring_frames'])
+        results = ctx.Queue()
+        stop = ctx.Event()
+        self._bg_request = ctx.Event()
+        # a spawned process reads the config afresh, so it needs telling about e.g. a camera's root
+        paths = (config.root, config.file_prefix)
+        workers = [ctx.Process(target=self._detect_worker, args=(paths, ix, n_detectors, ring, results, stop),
+                               name=f'ginji-detect-{ix}', daemon=True)
+                   for ix in range(n_detectors)]
+        workers.append(ctx.Process(target=self._capture_worker, args=(paths, ring, stop), name='ginji-capture',
+                                   daemon=True))
+        for w in workers:
+            w.start()
 
-        self.cam.resolution = (self._config['width'], self._config['height'])
-        time.sleep(2)
+        frame = np.empty(shape, np.uint8)
+        pending = {}
+        next_seq = 0
+        dropped = 0
+        # detection happens in the other processes, so only the wait for results is measured here
+        capture_wait = registry.histogram('ginji_stage_seconds', stage='capture_wait')
+        ring_drops = registry.counter('ginji_dropped_frames_total', 'Frames that were never analysed or stored.',
+                                      reason='ring')
+        lost = registry.counter('ginji_dropped_frames_total', reason='lost')
+        last_progress = time.time()
+        try:
+            while self.cont:
+                waiting = time.perf_counter()
+                try:
+                    seq, ok, detection = results.get(timeout=0.5)
+                    capture_wait.observe(time.perf_counter() - waiting)
+                    pending[seq] = (ok, detection)
+                except queue.Empty:
+                    pass
+                if next_seq in pending:
+                    last_progress = time.time()
+                elif time.time() - last_progress > 1:
+                    self._check_workers(workers)
+                    # a file or stream that has run out ends the capture process on its own
+                    if not workers[-1].is_alive() and next_seq > ring.latest:
+                        break
+                    if pending and time.time() - last_progress > self._config['stall_seconds']:
+                        # later frames have come back but this one hasn't; stop waiting for it
+                        pending[next_seq] = (False, None)
+                        lost.inc()
+                        last_progress = time.time()
+                while next_seq in pending:
+                    ok, detection = pending.pop(next_seq)
+                    timestamp = ring.read(next_seq, frame) if ok else None
+                    if timestamp is None:
+                        dropped += 1
+                        self.dropped_frames += 1
+                        ring_drops.inc()
+                    else:
+                        if dropped > 0:
+                            logger.debug(f'dropped {dropped} frames')
+                            dropped = 0
+                        yield frame, timestamp, detection
+                    next_seq += 1
+        finally:
+            stop.set()
+            for w in workers:
+                w.join(timeout=5)
+            self._bg_request = None
+            ring.close()
+            ring.unlink()
+
+    @staticmethod
+    def _check_workers(workers):
+        failed = [f'{w.name} (exit code {w.exitcode})' for w in workers if w.exitcode not in (None, 0)]
+        if failed:
+            raise RuntimeError(f'{", ".join(failed)} stopped unexpectedly')
+
+    def __getstate__(self):
+        # the capture and detector processes get a copy of this; leave out everything that
+        # belongs to this process, and let the detectors set up their own
+        state = self.__dict__.copy()
+        state.update(thread=None, _outputs=[], source=None, recorder=None, detector=None, bg_store=None)
+        return state
+
+    @staticmethod
+    def _init_worker(paths):
+        config.root, config.file_prefix = paths
+        # ctrl-c reaches the whole process group; leave it to the parent, which sets stop, so the
+        # detectors get to save their backgrounds on the way out
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    def _capture_worker(self, paths, ring, stop):
+        self._init_worker(paths)
+        self.open_source()
+        try:
+            for frame, timestamp in self.source.frames():
+                if stop.is_set():
+                    break
+                self._apply_rate()
+                ring.write(frame, timestamp)
+        finally:
+            self.source.close()
+
+    def _detect_worker(self, paths, ix, n_detectors, ring, results, stop):
+        self._init_worker(paths)
+        self.setup()
+        # the parent still holds the bg request event; only the first detector persists its background
+        self._bg_worker = ix == 0
+        frame = np.empty(ring.shape, ring.dtype)
+        next_seq = ix
+        while not stop.is_set():
+            if self._bg_worker and self._bg_request.is_set():
+                self._bg_request.clear()
+                self.save_bg()
+            latest = ring.latest
+            if latest < next_seq:
+                time.sleep(0.001)
+                continue
+            # anything older than the ring's oldest slot is gone; report it so the parent can move on
+            while next_seq <= latest - ring.slots:
+                results.put((next_seq, False, None))
+                next_seq += n_detectors
+            if ring.read(next_seq, frame) is None:
+                results.put((next_seq, False, None))
+            else:
+                results.put((next_seq, True, self.detect(frame)))
+            next_seq += n_detectors
+        if self._bg_worker:
+            self.save_bg()
+            self.bg_store.flush()
 
     def run(self):
-        raw_frame = PiRGBArray(self.cam, size=self.cam.resolution)
-        vid_frames = []
+        shape = (self._config['height'], self._config['width'], 3)
+        # in h264 mode the camera records the event itself, and streaming outputs encode as the
+        # frames arrive, so only buffer the whole event if something else needs it
+        buffering = self.needs_frames and not self.h264
+        if buffering:
+            store = frame_stores[self._config['frame_store']]
+            if store is JPEGFrameBuffer:
+                options = {'quality': self._config['jpeg_quality']}
+            else:
+                # once the event outgrows its memory budget, carry on in a file rather than drop frames
+                frame_bytes = int(np.prod(store.store_shape(shape)))
+                options = {
+                    'spill_dir': os.path.join(config.root, 'spill'),
+                    'spill_frames': int(self._config['spill_mb'] * 1048576) // frame_bytes
+                    }
+            # the outputs read each event's frames straight from its buffer, so there are a few to
+            # take turns, all inside the one budget
+            pool = BufferPool.from_budget(store, self._config['buffers'], shape, self._config['buffer_mb'],
+                                          self._config['pre_frames'], **options)
+            vid_frames = pool.get()
+            logger.debug(f'allocated {pool.nbytes / 1048576:.0f}MB for {len(pool.buffers)} buffers of '
+                         f'{vid_frames.capacity} frames')
+        else:
+            pre_frames = 0 if self.h264 else self._config['pre_frames']
+            vid_frames = FrameBuffer(shape, pre_frames + 1, pre_frames)
+        streams = {}
+        clip = None
         avg_centroids = []
         moving_frames = 0
         silent_frames = 0
-        total_frames = 0
-        total_time = 0
-        fps = 0
-        for f in self.cam.capture_continuous(raw_frame, format='bgr', use_video_port=True):
-            start = dt.now()
+        calm_frames = 0
+        self.set_active(False)
+        last_timestamp = None
+        frame_interval = None
+        capture_fast = self._fast.value
+        fps_gauge = registry.gauge('ginji_capture_fps', 'Wall-clock capture rate, smoothed.')
+        frames_counter = registry.counter('ginji_frames_total', 'Frames captured and analysed.')
+        buffer_drops = registry.counter('ginji_dropped_frames_total', reason='buffer')
+        events = registry.counter('ginji_events_total', 'Motion events, by outcome.', result='motion')
+        false_alarms = registry.counter('ginji_events_total', result='false_alarm')
+        # the frame with the most movement in the first poster_seconds of the event
+        poster_frame = None
+        poster_area = 0
+        poster_time = None
+        poster_sent = None
+        event_start = None
+
+        def capture_fps():
+            return 1 / frame_interval if frame_interval else self._config['framerate']
+
+        def stream_fps():
+            # the trigger brings capture back up to full speed, but the smoothed rate won't catch
+            # up for a while yet
+            return self._config['framerate'] if self._config['idle_framerate'] else capture_fps()
+
+        def send_poster():
+            nonlocal poster_sent
+            poster_sent = poster_time
+            self.preview(poster_frame.copy(), poster_time, centroids=list(avg_centroids))
+
+        def record(frame, timestamp):
+            for s in streams.values():
+                s.write(frame, timestamp)
+            if buffering:
+                vid_frames.add(frame, timestamp)
+
+        for frame, timestamp, detection in self.frames():
             if not self.cont:
                 break
-            frame = f.array[
-                    int(480 * self._config['crop_top']):int(480 * self._config['crop_bottom']),
-                    int(640 * self._config['crop_left']):int(640 * self._config['crop_right'])]
-            imgrey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            imgrey = cv2.GaussianBlur(imgrey, (21, 21), 0)
-            if self.background is None:
-                self.background = imgrey.copy().astype('float')
-                self.save_bg()
-                raw_frame.truncate(0)
-                logger.debug('initialised background')
+            if self._fast.value != capture_fast:
+                # the rate changed; start measuring it again instead of averaging across the switch
+                capture_fast = self._fast.value
+                last_timestamp = None
+                frame_interval = None
+            if last_timestamp is not None:
+                interval = timestamp - last_timestamp
+                frame_interval = interval if frame_interval is None else 0.9 * frame_interval + 0.1 * interval
+                if frame_interval > 0:
+                    fps_gauge.set(1 / frame_interval)
+            frames_counter.inc()
+            last_timestamp = timestamp
+            if detection is None:
                 continue
 
-            cv2.accumulateWeighted(imgrey, self.background, 0.5)
-            frame_delta = cv2.absdiff(imgrey, cv2.convertScaleAbs(self.background))
-            frame_threshold = cv2.threshold(frame_delta, 20, 255, cv2.THRESH_BINARY)[1]
-            frame_dilated = cv2.dilate(frame_threshold, None, iterations=10)
-            contours, hier = cv2.findContours(frame_dilated, cv2.RETR_TREE,
-                                                   cv2.CHAIN_APPROX_SIMPLE)
+            # drop back to the idle frame rate once things have been quiet for a while
+            if detection.motion or moving_frames > 0:
+                calm_frames = 0
+                self.set_active(True)
+            elif self._fast.value:
+                calm_frames += 1
+                if calm_frames >= self._config['max_silent_frames']:
+                    calm_frames = 0
+                    self.set_active(False)
 
-            motion = [c for c in contours if cv2.contourArea(c) >= self._config['min_area']]
-            frame_centroids = []
-
-            for c in motion:
-                m = cv2.moments(c)
-                cx = int(m['m10'] / m['m00'])
-                frame_centroids.append(cx)
-
-            if len(motion) == 0:
+            if not detection.motion:
                 if moving_frames != 0:
                     silent_frames += 1
                     if silent_frames == self._config['max_silent_frames']:
                         self._motion = False
                         if moving_frames >= self._config['min_moving_frames']:
                             logger.debug('movement ended')
-                            try:
-                                self.output(vid_frames, math.floor(fps * 0.6), centroids=avg_centroids)
-                            except Exception as e:
-                                logger.debug('failed to upload video')
-                                logger.debug(e)
+                            if poster_sent is None:
+                                send_poster()
+                            events.inc()
+                            if vid_frames.dropped > 0:
+                                buffer_drops.inc(vid_frames.dropped)
+                                logger.debug(f'buffer full, dropped {vid_frames.dropped} frames')
+                            if buffering:
+                                logger.debug(f'event used {vid_frames.stored_bytes / 1048576:.1f}MB for '
+                                             f'{len(vid_frames)} frames '
+                                             f'({vid_frames.spilled_bytes / 1048576:.1f}MB spilled to disk), '
+                                             f'{1000 * vid_frames.store_cost:.1f}ms to store each frame')
+                            for s in streams.values():
+                                s.close()
+                            if clip is not None:
+                                self.recorder.release()
+                                self.output(clip, clip.fps, centroids=list(avg_centroids), poster=poster_sent)
+                            else:
+                                fps = (vid_frames.fps if buffering else None) or stream_fps()
+                                self.output(vid_frames if buffering else None, fps, centroids=list(avg_centroids),
+                                            streams=streams, poster=poster_sent)
+                                if buffering:
+                                    # the outputs have this buffer now; carry on in a free one
+                                    vid_frames = pool.get(False)
+                                    if vid_frames is None:
+                                        # they're all lent out; the queue policy decides what gives
+                                        self.unpool()
+                                        vid_frames = pool.get()
                         else:
+                            for s in streams.values():
+                                s.abort()
+                            if clip is not None:
+                                self.recorder.release()
+                                clip.discard()
+                            false_alarms.inc()
                             logger.debug('false alarm, sorry')
                         self.save_bg()
                         moving_frames = 0
-                        vid_frames.clear()
+                        self._event_active.value = 0
+                        streams = {}
+                        clip = None
+                        vid_frames.reset()
                         avg_centroids.clear()
+                        poster_area = 0
+                        poster_sent = None
                     else:
-                        vid_frames.append(f.array)
+                        record(frame, timestamp)
                         avg_centroids.append(avg_centroids[-1])
+                else:
+                    # keep the pre-trigger window topped up
+                    vid_frames.add(frame, timestamp)
             else:
                 moving_frames += 1
                 silent_frames = 0
-                vid_frames.append(f.array)
-                avg_centroids.append(np.mean(frame_centroids))
+                if moving_frames == 1:
+                    self._event_active.value = 1
+                    event_start = timestamp
+                    vid_frames.trigger()
+                    if self.recorder is not None:
+                        clip = self.recorder.trigger()
+                    else:
+                        streams = self.open_streams(vid_frames.shape, stream_fps())
+                        for f, t in vid_frames.items():
+                            for s in streams.values():
+                                s.write(f, t)
+                record(frame, timestamp)
+                avg_centroids.append(np.mean(detection.centroids[:, 0]))
+                area = detection.areas.max()
+                if poster_sent is None and area > poster_area:
+                    poster_area = area
+                    poster_time = timestamp
+                    if poster_frame is None or poster_frame.shape != frame.shape:
+                        poster_frame = np.empty_like(frame)
+                    np.copyto(poster_frame, frame)
+                if poster_sent is None and moving_frames >= self._config['min_moving_frames'] and \
+                        timestamp - event_start >= self._config['poster_seconds']:
+                    # an early alert is worth more than the best possible frame
+                    send_poster()
                 if moving_frames == 1:
                     logger.debug('what was that??')
                 if moving_frames == self._config['min_moving_frames']:
                     self._motion = True
                     logger.debug('movement detected')
-
-            raw_frame.truncate(0)
-            total_time += (dt.now() - start).total_seconds()
-            total_frames += 1
-            fps = total_frames / total_time
-            frame_centroids.clear()
-        self.cam.close()
-        logger.debug('camera closed, thread terminated')
+        for s in streams.values():
+            s.abort()
+        if clip is not None:
+            clip.discard()
+        logger.debug('thread terminated')
 
     def save_bg(self):
-        with open(self.bgfile, 'wb') as file:
-            pickle.dump(self.background, file)
+        if self._bg_request is not None and not self._bg_worker:
+            # the background lives in a detector process; ask it to save instead
+            self._bg_request.set()
+            return
+        if not self.detector.saves_background or self.background is None:
+            # the subtractor engines keep their own model
+            return
+        self.bg_store.save(self.background)
+
+    def stop(self):
+        super(MotionInput, self).stop()
+        self.bg_store.flush()
 
     @property
     def value(self):
@@ -0,0 +1,82 @@
+import os
+import time
+
+import ffmpy
+
+
+class H264Clip(object):
+    """
+    An event recorded by the camera's own encoder: the pre-roll pulled out of the circular
+    stream, followed by everything recorded after the trigger.
+    """
+
+    def __init__(self, before, after, fps):
+        self.before = before
+        self.after = after
+        self.fps = fps
+
+    def save(self, path):
+        """
+        Mux the two halves into a single file without re-encoding, then delete them.
+
+        :param path: the output file, e.g. an mp4
+
+        """
+        parts = '|'.join(p for p in (self.before, self.after) if os.path.exists(p))
+        ff = ffmpy.FFmpeg(inputs={
+            f'concat:{parts}': f'-f h264 -framerate {self.fps}'
+            }, outputs={
+            path: '-c copy -y'
+            }, global_options=['-nostats -loglevel 0 -fflags +genpts'])
+        ff.run()
+        self.discard()
+
+    def discard(self):
+        for p in (self.before, self.after):
+            if os.path.exists(p):
+                os.remove(p)
+
+
+class CircularRecorder(object):
+    """
+    Keeps the last few seconds of H.264 from the camera's GPU encoder in memory. When something
+    happens, recording is split off to a file and the buffered pre-roll is written out next to it.
+    """
+
+    def __init__(self, camera, path, seconds, bitrate, splitter_port=1):
+        self.camera = camera
+        self.path = path
+        self.seconds = seconds
+        self.bitrate = bitrate
+        self.splitter_port = splitter_port
+        self.stream = None
+        if not os.path.exists(self.path):
+            os.mkdir(self.path)
+
+    def start(self):
+        import picamera
+        self.stream = picamera.PiCameraCircularIO(self.camera, seconds=self.seconds,
+                                                  splitter_port=self.splitter_port)
+        self.camera.start_recording(self.stream, format='h264', bitrate=self.bitrate,
+                                    splitter_port=self.splitter_port)
+
+    def trigger(self):
+        """
+        Start recording to a file, and save the pre-roll.
+
+        :return: H264Clip
+
+        """
+        prefix = os.path.join(self.path, f'{time.time():.6f}')
+        clip = H264Clip(prefix + '-before.h264', prefix + '-after.h264', float(self.camera.framerate))
+        self.camera.split_recording(clip.after, splitter_port=self.splitter_port)
+        self.stream.copy_to(clip.before, seconds=self.seconds)
+        self.stream.clear()
+        return clip
+
+    def release(self):
+        """Go back to recording into the circular stream."""
+        self.camera.split_recording(self.stream, splitter_port=self.splitter_port)
+
+    def stop(self):
+        self.camera.stop_recording(splitter_port=self.splitter_port)
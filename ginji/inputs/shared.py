@@ -0,0 +1,88 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedFrameRing(object):
+    """
+    A ring of frames in shared memory, written by one process and read by any number of others.
+    Every slot records the sequence number of the frame it holds, so readers can tell when
+    they've fallen behind and the frame they wanted has already been overwritten.
+    """
+
+    def __init__(self, shape, slots, dtype=np.uint8, name=None):
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.dtype = np.dtype(dtype)
+        frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        # head sequence number, then a sequence number and a timestamp for each slot
+        header_bytes = 8 * (1 + 2 * slots)
+        create = name is None
+        self._shm = shared_memory.SharedMemory(name=name, create=create,
+                                               size=header_bytes + frame_bytes * slots)
+        buf = self._shm.buf
+        self._head = np.ndarray((1,), np.int64, buf, 0)
+        self._seqs = np.ndarray((slots,), np.int64, buf, 8)
+        self._times = np.ndarray((slots,), np.float64, buf, 8 * (1 + slots))
+        self._frames = np.ndarray((slots,) + self.shape, self.dtype, buf, header_bytes)
+        if create:
+            self._head[0] = -1
+            self._seqs[:] = -1
+
+    def __reduce__(self):
+        # reattach by name when sent to a spawned process
+        return self.__class__, (self.shape, self.slots, self.dtype, self.name)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def latest(self):
+        """The sequence number of the most recently written frame, or -1 if there isn't one."""
+        return int(self._head[0])
+
+    def write(self, frame, timestamp):
+        """
+        Copy a frame into the next slot, overwriting the oldest.
+
+        :param frame: an array with the ring's frame shape
+        :param timestamp: the capture time of the frame
+        :return: the frame's sequence number
+
+        """
+        seq = self.latest + 1
+        slot = seq % self.slots
+        # mark the slot as in-progress so readers don't take a half-written frame
+        self._seqs[slot] = -1
+        np.copyto(self._frames[slot], frame)
+        self._times[slot] = timestamp
+        self._seqs[slot] = seq
+        self._head[0] = seq
+        return seq
+
+    def read(self, seq, out):
+        """
+        Copy the frame with the given sequence number into out.
+
+        :param seq: the sequence number of the frame
+        :param out: an array to copy the frame into
+        :return: the frame's timestamp, or None if it has been overwritten
+
+        """
+        slot = seq % self.slots
+        if self._seqs[slot] != seq:
+            return None
+        np.copyto(out, self._frames[slot])
+        timestamp = float(self._times[slot])
+        # if the writer lapped us while we were copying, the frame is garbage
+        if self._seqs[slot] != seq:
+            return None
+        return timestamp
+
+    def close(self):
+        self._head = self._seqs = self._times = self._frames = None
+        self._shm.close()
+
+    def unlink(self):
+        self._shm.unlink()
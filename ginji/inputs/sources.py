@@ -0,0 +1,357 @@
+"""
+Where frames come from. Each source opens its device (or file, or stream), hands out BGR frames
+at the configured size with the time they were taken, and can be slowed down to an idle frame
+rate. picamera is only imported by the source that needs it, so hosts without one can still run.
+"""
+
+import threading
+import time
+from abc import ABC, abstractmethod
+
+import cv2
+import numpy as np
+
+from ginji.config import logger
+from ginji.metrics import registry
+
+
+class BaseSource(ABC):
+    """Produces frames for a MotionInput."""
+
+    config_name = 'base'
+
+    def __init__(self, width, height, framerate):
+        self.size = (width, height)
+        self.framerate = framerate
+        self.camera = None
+        self._interval = 0
+
+    @abstractmethod
+    def open(self):
+        pass
+
+    @abstractmethod
+    def close(self):
+        pass
+
+    @abstractmethod
+    def _frames(self):
+        """A generator of (frame, timestamp) tuples, straight from the source."""
+        pass
+
+    def frames(self, **kwargs):
+        """
+        Read frames until the source runs out or the caller stops asking. Frames may be reused
+        once the next one is requested.
+
+        :return: a generator of (frame, timestamp) tuples
+
+        """
+        last = None
+        for frame, timestamp in self._frames(**kwargs):
+            # at the idle frame rate, skip anything that arrives before the next one is due
+            if self._interval and last is not None and \
+                    timestamp - last < self._interval - 0.5 / self.framerate:
+                continue
+            last = timestamp
+            yield self._fit(frame), timestamp
+
+    def set_framerate(self, framerate):
+        """
+        Change the frame rate while the source is running.
+
+        :param framerate: frames per second; the configured rate or lower
+
+        """
+        self._interval = 1 / framerate if framerate < self.framerate else 0
+
+    def _fit(self, frame):
+        if frame.shape[1::-1] != self.size:
+            frame = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        return frame
+
+
+class PiCameraSource(BaseSource):
+    """The Pi's own CSI camera."""
+
+    config_name = 'picamera'
+
+    def __init__(self, width, height, framerate, resolution=None):
+        super(PiCameraSource, self).__init__(width, height, framerate)
+        # the sensor can run bigger than the frames handed out, e.g. while recording h264
+        self.resolution = tuple(resolution or self.size)
+
+    def open(self):
+        import picamera
+        self.camera = picamera.PiCamera()
+        self.camera.resolution = self.resolution
+        self.camera.framerate = self.framerate
+        time.sleep(2)
+
+    def close(self):
+        self.camera.close()
+        self.camera = None
+
+    def _frames(self, **capture_options):
+        from picamera.array import PiRGBArray
+        raw_frame = PiRGBArray(self.camera, size=self.size)
+        for f in self.camera.capture_continuous(raw_frame, format='bgr', use_video_port=True,
+                                                **capture_options):
+            # picamera only reports frame timestamps while recording, so use arrival time
+            yield f.array, time.time()
+            raw_frame.truncate(0)
+
+    def frames(self, **capture_options):
+        # the GPU already scales and paces the frames
+        return self._frames(**capture_options)
+
+    def set_framerate(self, framerate):
+        # unlike framerate, the delta can be changed while the camera is running
+        self.camera.framerate_delta = min(framerate, self.framerate) - self.framerate
+
+
+class GrabberSource(BaseSource):
+    """
+    Reads from an OpenCV capture on a thread of its own, always keeping just the newest frame, so
+    a slow detector gets the latest picture rather than a backlog of old ones.
+    """
+
+    config_name = 'grabber'
+
+    def __init__(self, width, height, framerate):
+        super(GrabberSource, self).__init__(width, height, framerate)
+        self.capture = None
+        self._frame = None
+        self._timestamp = None
+        self._seq = 0
+        self._taken = 0
+        self._stopped = False
+        self._thread = None
+        self._ready = threading.Condition()
+        self._dropped = registry.counter('ginji_dropped_frames_total', reason='grabber')
+
+    @abstractmethod
+    def _open_capture(self):
+        """:return: an opened cv2.VideoCapture"""
+        pass
+
+    def open(self):
+        self.capture = self._open_capture()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._grab, name=f'ginji-{self.config_name}', daemon=True)
+        self._thread.start()
+
+    def _grab(self):
+        while not self._stopped:
+            ok, frame = self.capture.read()
+            if not ok:
+                if not self._reconnect():
+                    break
+                continue
+            with self._ready:
+                if self._taken < self._seq:
+                    # the reader never got to the last one
+                    self._dropped.inc()
+                # each read is a new array, so the reader can keep the old one as long as it likes
+                self._frame = frame
+                self._timestamp = time.time()
+                self._seq += 1
+                self._ready.notify_all()
+        with self._ready:
+            self._stopped = True
+            self._ready.notify_all()
+
+    def _reconnect(self):
+        """Called when a read fails. :return: True to carry on reading"""
+        logger.error(f'{self.config_name} source stopped returning frames')
+        return False
+
+    def _frames(self):
+        while True:
+            with self._ready:
+                while self._taken == self._seq and not self._stopped:
+                    self._ready.wait(1)
+                if self._taken == self._seq:
+                    return
+                self._taken = self._seq
+                frame, timestamp = self._frame, self._timestamp
+            yield frame, timestamp
+
+    def close(self):
+        self._stopped = True
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self.capture.release()
+
+
+class V4L2Source(GrabberSource):
+    """A USB (or any other video4linux) camera."""
+
+    config_name = 'v4l2'
+
+    def __init__(self, width, height, framerate, device=0, fourcc='MJPG'):
+        super(V4L2Source, self).__init__(width, height, framerate)
+        self.device = device
+        self.fourcc = fourcc
+
+    def _open_capture(self):
+        capture = cv2.VideoCapture(self.device, cv2.CAP_V4L2)
+        if not capture.isOpened():
+            raise IOError(f'Unable to open video device {self.device}.')
+        # mjpeg gets most usb cameras past the bandwidth limit of raw frames
+        if self.fourcc:
+            capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*self.fourcc))
+        capture.set(cv2.CAP_PROP_FRAME_WIDTH, self.size[0])
+        capture.set(cv2.CAP_PROP_FRAME_HEIGHT, self.size[1])
+        capture.set(cv2.CAP_PROP_FPS, self.framerate)
+        capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        return capture
+
+
+class StreamSource(GrabberSource):
+    """
+    A network stream, e.g. rtsp:// from an IP camera, or from a local server replaying a file. It
+    reconnects if the stream drops.
+    """
+
+    config_name = 'stream'
+
+    def __init__(self, width, height, framerate, url=None, reconnect_seconds=5):
+        super(StreamSource, self).__init__(width, height, framerate)
+        if url is None:
+            raise ValueError('The stream source needs a url.')
+        self.url = url
+        self.reconnect_seconds = reconnect_seconds
+
+    def _open_capture(self):
+        capture = cv2.VideoCapture(self.url, cv2.CAP_FFMPEG)
+        capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        return capture
+
+    def _reconnect(self):
+        logger.error(f'lost {self.url}; reconnecting in {self.reconnect_seconds}s')
+        self.capture.release()
+        time.sleep(self.reconnect_seconds)
+        if not self._stopped:
+            self.capture = self._open_capture()
+        return not self._stopped
+
+
+class ReplaySource(BaseSource):
+    """
+    Frames that can be read faster than real time, e.g. from a file. Timestamps follow the frame
+    count rather than the clock, so events come out the same at any speed.
+    """
+
+    config_name = 'replay'
+
+    def __init__(self, width, height, framerate, realtime=True, start=None):
+        super(ReplaySource, self).__init__(width, height, framerate)
+        self.realtime = realtime
+        # the first frame's timestamp; the time it's read, by default
+        self.start = start
+
+    @abstractmethod
+    def _read(self):
+        """:return: the next frame, or None when there aren't any more"""
+        pass
+
+    def _frames(self):
+        clock = time.time()
+        start = clock if self.start is None else self.start
+        n = 0
+        while True:
+            frame = self._read()
+            if frame is None:
+                return
+            if self.realtime:
+                time.sleep(max(0, clock + n / self.framerate - time.time()))
+            yield frame, start + n / self.framerate
+            n += 1
+
+
+class FileSource(ReplaySource):
+    """Replays a video file, at its own frame rate or as fast as it can be read."""
+
+    config_name = 'file'
+
+    def __init__(self, width, height, framerate, path=None, loop=False, realtime=True, start=None):
+        super(FileSource, self).__init__(width, height, framerate, realtime, start)
+        if path is None:
+            raise ValueError('The file source needs a path.')
+        self.path = path
+        self.loop = loop
+        self.capture = None
+
+    def open(self):
+        self.capture = cv2.VideoCapture(self.path)
+        if not self.capture.isOpened():
+            raise IOError(f'Unable to open {self.path}.')
+        self.framerate = self.capture.get(cv2.CAP_PROP_FPS) or self.framerate
+
+    def close(self):
+        self.capture.release()
+
+    def _read(self):
+        ok, frame = self.capture.read()
+        if not ok and self.loop and self.capture.get(cv2.CAP_PROP_POS_FRAMES) > 0:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, frame = self.capture.read()
+        return frame if ok else None
+
+
+class SyntheticSource(ReplaySource):
+    """
+    A made-up scene: a noisy grey background with a blob crossing it every so often. It needs
+    nothing but numpy, and knows exactly when each event happened, so it's what the benchmarks
+    use.
+    """
+
+    config_name = 'synthetic'
+
+    def __init__(self, width, height, framerate, events=5, event_seconds=3, gap_seconds=5, radius=60,
+                 noise=4, seed=0, realtime=False, start=None):
+        super(SyntheticSource, self).__init__(width, height, framerate, realtime, start)
+        self.radius = radius
+        event_frames = int(event_seconds * framerate)
+        gap_frames = int(gap_seconds * framerate)
+        # (first frame, last frame) of each crossing, with a gap before each one and after the last
+        self.event_frames = [(gap_frames + i * (event_frames + gap_frames),
+                              gap_frames + i * (event_frames + gap_frames) + event_frames - 1)
+                             for i in range(events)]
+        self.total_frames = gap_frames + events * (event_frames + gap_frames)
+        random = np.random.default_rng(seed)
+        # a few frames of noise, reused in turn, are enough to keep the detector honest
+        background = np.full((height, width, 3), 110, np.int16)
+        self._noise = [np.clip(background + random.normal(0, noise, background.shape), 0, 255).astype(np.uint8)
+                       for _ in range(8)]
+        self._n = 0
+
+    @property
+    def events(self):
+        """The (start, end) seconds of each crossing, from the first frame."""
+        return [(a / self.framerate, (b + 1) / self.framerate) for a, b in self.event_frames]
+
+    def open(self):
+        self._n = 0
+
+    def close(self):
+        pass
+
+    def _read(self):
+        if self._n >= self.total_frames:
+            return None
+        frame = self._noise[self._n % len(self._noise)].copy()
+        for i, (first, last) in enumerate(self.event_frames):
+            if first <= self._n <= last:
+                progress = (self._n - first) / max(1, last - first)
+                # alternate directions, so the direction logic gets a workout too
+                if i % 2:
+                    progress = 1 - progress
+                x = int(-self.radius + progress * (self.size[0] + 2 * self.radius))
+                cv2.circle(frame, (x, self.size[1] // 2), self.radius, (230, 230, 230), -1)
+        self._n += 1
+        return frame
+
+
+sources = {s.config_name: s for s in [PiCameraSource, V4L2Source, StreamSource, FileSource, SyntheticSource]}
@@ -0,0 +1,243 @@
+import collections
+import json
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from ginji.config import logger
+
+# seconds; covers everything from a single opencv call up to a slow upload
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [('', {}, self.value)]
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(object):
+    kind = 'gauge'
+
+    def __init__(self, fn=None):
+        self.fn = fn
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    @property
+    def value(self):
+        return self.fn() if self.fn is not None else self._value
+
+    def samples(self):
+        return [('', {}, self.value)]
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram(object):
+    """
+    Fixed buckets for prometheus, plus the most recent observations so percentiles reflect what's
+    happening now rather than since startup.
+    """
+    kind = 'histogram'
+
+    def __init__(self, buckets=BUCKETS, window=1024):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self.recent = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+            self.recent.append(value)
+
+    def time(self):
+        return _Timer(self)
+
+    def samples(self):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = 0
+        samples = []
+        for le, c in zip(self.buckets + (float('inf'),), counts):
+            cumulative += c
+            samples.append(('_bucket', {'le': '+Inf' if le == float('inf') else repr(le)}, cumulative))
+        samples.append(('_sum', {}, total))
+        samples.append(('_count', {}, count))
+        return samples
+
+    def snapshot(self):
+        with self._lock:
+            recent = sorted(self.recent)
+            count, total = self.count, self.sum
+        if not recent:
+            return {'count': count}
+
+        def percentile(p):
+            return recent[min(len(recent) - 1, int(p * len(recent)))]
+
+        return {
+            'count': count,
+            'mean': total / count,
+            'p50': percentile(0.5),
+            'p95': percentile(0.95),
+            'p99': percentile(0.99),
+            'max': recent[-1]
+            }
+
+
+class _Timer(object):
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Registry(object):
+    """Every metric in the process, keyed by name and labels."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help_text, labels, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = cls(**kwargs)
+                    self._metrics[key] = metric
+                    self._help.setdefault(name, help_text)
+        return metric
+
+    def counter(self, name, help_text='', **labels):
+        return self._get(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text='', fn=None, **labels):
+        gauge = self._get(Gauge, name, help_text, labels)
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name, help_text='', **labels):
+        return self._get(Histogram, name, help_text, labels)
+
+    def reset(self):
+        """Forget every metric, e.g. between benchmark runs."""
+        with self._lock:
+            self._metrics.clear()
+
+    def render(self):
+        """All the metrics in prometheus' text format."""
+        lines = []
+        seen = set()
+        for (name, labels), metric in sorted(self._metrics.items(), key=lambda x: x[0]):
+            if name not in seen:
+                seen.add(name)
+                lines.append(f'# HELP {name} {self._help.get(name, "")}')
+                lines.append(f'# TYPE {name} {metric.kind}')
+            for suffix, extra, value in metric.samples():
+                merged = dict(labels, **extra)
+                label_text = ','.join(f'{k}="{v}"' for k, v in merged.items())
+                lines.append(f'{name}{suffix}{{{label_text}}} {value}' if label_text else
+                             f'{name}{suffix} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """All the metrics as a json-friendly dict, histograms summarised as percentiles."""
+        snapshot = {}
+        for (name, labels), metric in sorted(self._metrics.items(), key=lambda x: x[0]):
+            label_text = ','.join(f'{k}={v}' for k, v in labels)
+            snapshot[f'{name}{{{label_text}}}' if label_text else name] = metric.snapshot()
+        return snapshot
+
+
+registry = Registry()
+
+
+def stage(name):
+    """
+    Time a stage of the pipeline:
+
+        with stage('blur'):
+            ...
+
+    :param name: the stage label
+    :return: a context manager
+
+    """
+    return registry.histogram('ginji_stage_seconds', 'Time spent in each stage of the pipeline.',
+                              stage=name).time()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith('/metrics'):
+            body = registry.render().encode()
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path.startswith('/stats'):
+            body = json.dumps(registry.snapshot()).encode()
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port, host='127.0.0.1'):
+    """
+    Serve /metrics (prometheus) and /stats (json) on a background thread.
+
+    :param port: 0 turns it off
+    :return: the server, or None
+
+    """
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _Handler)
+    except OSError as e:
+        logger.error(f'Unable to serve metrics on {host}:{port}: {e}')
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='ginji-metrics', daemon=True).start()
+    logger.debug(f'serving metrics on http://{host}:{port}/metrics')
+    return server
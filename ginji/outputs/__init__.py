@@ -1,2 +1,12 @@
-from .text import TextOutput
-from .media import VideoOutput
+from ginji import registry
+
+_classes = {
+    'TextOutput': 'text',
+    'VideoOutput': 'video'
+    }
+
+
+def __getattr__(name):
+    if name in _classes:
+        return registry.load('outputs', _classes[name])
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
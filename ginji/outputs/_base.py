@@ -1,12 +1,20 @@
 from abc import ABC, abstractmethod
 
+from ginji.config import config
+
 
 class BaseOutput(ABC):
     """An object causing an effect in the system, e.g. a buzzer or a camera."""
 
+    config_name = 'base'
+
     def __init__(self):
         self._uploaders = []
         self._notifiers = []
+        self._config = self.load_config()
+
+    def load_config(self):
+        return config.output_config.get(self.config_name, {})
 
     def register_connectors(self, *connectors):
         """Register connectors to run after the fire event.
@@ -1,19 +1,34 @@
+import multiprocessing
 import os
+import queue
+import shutil
+import threading
 import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-import cv2
-import ffmpy
 
 from ginji.config import config, logger
+from ginji.metrics import registry, stage
 from ._base import BaseOutput
+from .renditions import lower_priority, render, renditions
+from .uploads import UploadQueue
+
+
+# opencv is imported where it's used, so loading an output (e.g. to sweep up old files) stays quick
 
 
 class MediaOutput(BaseOutput):
-    def __init__(self, filetype='jpg'):
+    def __init__(self, filetype='jpg', create=True):
+        """
+        :param filetype: the extension of the files this makes
+        :param create: make the output folders if they aren't there; False for just looking
+
+        """
         super(MediaOutput, self).__init__()
         self.filetype = filetype
         self.file_root = os.path.join(config.root, 'media')
-        if not os.path.exists(self.file_root):
+        if create and not os.path.exists(self.file_root):
             os.mkdir(self.file_root)
         self.initial = os.path.join(self.file_root, 'temp.' + filetype)
         self.path = os.path.join(self.file_root, 'temp.' + filetype)
@@ -21,12 +36,27 @@ class MediaOutput(BaseOutput):
         self.filename_set = False
         self.time_taken = None
         self.processing = False
+        self._upload_queue = None
+        self._queue_lock = threading.Lock()
+
+    def load_config(self):
+        basic_config = super(MediaOutput, self).load_config()
+        return {
+            'upload_workers': basic_config.get('upload_workers', 2),
+            'retry_base': basic_config.get('retry_base', 30),
+            'retry_max': basic_config.get('retry_max', 3600),
+            'ledger_days': basic_config.get('ledger_days', 90)
+            }
 
     @property
     def direction_msg(self):
-        if self.direction == 1:
+        return self.describe(self.direction)
+
+    @staticmethod
+    def describe(direction):
+        if direction == 1:
             return "came in"
-        elif self.direction == 2:
+        elif direction == 2:
             return "is being a quantum boy"
         else:
             return "went out"
@@ -35,10 +65,10 @@ class MediaOutput(BaseOutput):
         if not self.filename_set:
             self.direction = value
 
-    def make_filename(self, time_object, direction):
+    def make_filename(self, time_object, direction, filetype=None):
         t = str(time_object).replace('.', '_')
         return os.path.join(self.file_root,
-                            f'{config.file_prefix}_{t}-{direction}.' + self.filetype)
+                            f'{config.file_prefix}_{t}-{direction}.' + (filetype or self.filetype))
 
     def auto_filename(self):
         self.time_taken = time.time()
@@ -52,89 +82,479 @@ class MediaOutput(BaseOutput):
 
     def clean(self):
         """
-        Clean up unnecessary files.
+        Clean up unnecessary files. Queued files are deleted by the upload queue instead, so
+        this is only for files that won't be uploaded.
         :return:
         """
-        if os.path.exists(self.initial):
-            if os.path.exists(self.path) and os.stat(self.path).st_size == os.stat(
-                    self.initial).st_size:
-                os.remove(self.initial)
-            else:
-                # if it doesn't match, something probably crashed; rename the temporary file and
-                # it'll get uploaded at some point
-                self.auto_filename()
-                self.rename()
-                self.connect()
-                os.remove(self.initial)
+        if os.path.exists(self.initial) and self.initial != self.path:
+            os.remove(self.initial)
         if os.path.exists(self.path):
             os.remove(self.path)
         self.filename_set = False
 
-    def tidy(self):
-        untidy_files = [f for f in os.listdir(self.file_root) if f.endswith(self.filetype)]
+    def in_use(self):
+        """Files that are still being written, which tidy() should leave alone."""
+        return set()
+
+    def tidy(self, workers=1, progress=None):
+        """
+        Queue any files that haven't been uploaded yet.
+
+        :param workers: how many files to hash at once
+        :param progress: optional callable, given (files done, total) after each file
+
+        """
+        if os.path.exists(self.initial) and not self.processing:
+            # something probably crashed; rename the temporary file so it gets uploaded
+            self.auto_filename()
+            self.rename()
+            self.filename_set = False
+        # only new files and ones the ledger says are unfinished need looking at
+        in_use = self.in_use()
+        # temp_ files are streams, which only get a real name once they're finished
+        untidy_files = self.upload_queue.scan(self.file_root, self.filetype, ignore='temp_')
+        untidy_files = set(untidy_files).union(self.upload_queue.pending())
+        untidy_files = sorted(f for f in untidy_files if f not in in_use and f != self.initial
+                              and not os.path.basename(f).startswith('temp_'))
         logger.debug(f'Tidying up {len(untidy_files)} leftover files.')
-        for f in untidy_files:
-            self.path = os.path.join(self.file_root, f)
-            self.connect()
-            self.clean()
+        with ThreadPoolExecutor(max(1, workers)) as pool:
+            for i, _ in enumerate(pool.map(self._queue_file, untidy_files)):
+                if progress is not None:
+                    progress(i + 1, len(untidy_files))
 
     def fire(self, **kwargs):
         self.processing = True
         self.auto_filename()
         self.rename()
-        if self.connect():
-            logger.debug('Cleaning up.')
-            self.clean()
+        self.connect(**kwargs)
+        self.filename_set = False
         self.processing = False
 
-    def connect(self, **kwargs):
-        errors = 0
-        uploads = {}
-        for u in self._uploaders:
-            try:
-                uploads[u.config_name] = u.run(self.path)
-            except Exception as e:
-                logger.error(f'Unable to upload {self.path} to {u.config_name}.')
-                errors += 1
-        for n in self._notifiers:
-            try:
-                n.run(uploads, self.time_taken, self.direction_msg)
-            except Exception as e:
-                logger.error(f'Unable to send payload to {n.config_name}.')
-                errors += 1
-        return errors == 0
+    @property
+    def upload_queue(self):
+        # posters are queued from the input's thread, so this can be reached from two at once
+        with self._queue_lock:
+            if self._upload_queue is None:
+                self._upload_queue = UploadQueue(self._uploaders + self._notifiers,
+                                                 workers=self._config['upload_workers'],
+                                                 retry_base=self._config['retry_base'],
+                                                 retry_max=self._config['retry_max'],
+                                                 keep_days=self._config['ledger_days'])
+        return self._upload_queue
+
+    def connect(self, notify=True, **kwargs):
+        """
+        Queue the current file for every connector. The queue deletes it once they've all run.
+
+        :param notify: whether to run the notifiers for this file too
+        :return: True if there was anything new to queue
+
+        """
+        return self._queue_file(self.path, notify)
+
+    def _queue_file(self, path, notify=True):
+        if os.path.exists(path):
+            return self.upload_queue.add(path, self.time_taken, self.direction_msg, notify) > 0
+        return False
+
+    def wait_for_uploads(self, progress=None):
+        """
+        Block until the queue has done everything it can for now.
+
+        :param progress: optional callable, called about once a second while waiting
+
+        """
+        self.upload_queue.wait(progress)
+
+
+class VideoStream(object):
+    """
+    Encodes frames on its own thread as they arrive, so the file is ready almost as soon as the
+    event ends. Frames are placed by their timestamps: if capture stalls, the last frame is
+    repeated, and if frames come in faster than fps, the extras are skipped, so the video plays
+    back in real time.
+    """
+
+    def __init__(self, path, shape, fps, fourcc='X264', maxsize=64):
+        self.path = path
+        self.fps = fps
+        self.dropped = 0
+        # set if the encoder couldn't be opened
+        self.error = None
+        self._size = tuple(shape[1::-1])
+        self._fourcc = fourcc
+        self._aborted = False
+        self._queue = queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self._run, name='ginji-stream', daemon=True)
+        self._thread.start()
+
+    def write(self, frame, timestamp):
+        # the caller is going to reuse its array, so take a copy
+        try:
+            self._queue.put_nowait((frame.copy(), timestamp))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Finish writing the queued frames; doesn't wait for them."""
+        self._queue.put(None)
+
+    def abort(self):
+        """Stop writing and delete the file."""
+        self._aborted = True
+        self.close()
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def save(self, path):
+        """
+        Wait for the encoder to finish, then move the file to path.
+
+        :param path: where the finished video should go
+
+        """
+        self.wait()
+        if self.error is not None:
+            raise self.error
+        if os.path.exists(self.path):
+            os.replace(self.path, path)
+
+    def _run(self):
+        import cv2
+        out = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*self._fourcc), self.fps,
+                              self._size, True)
+        if not out.isOpened():
+            self.error = IOError(f'Unable to open a {self._fourcc} encoder for {self.path}.')
+            logger.error(str(self.error))
+            # keep taking frames until the event ends, so nothing waits on a full queue
+            while self._queue.get() is not None:
+                pass
+            return
+        first_timestamp = None
+        last_frame = None
+        written = 0
+        while True:
+            item = self._queue.get()
+            if item is None or self._aborted:
+                break
+            frame, timestamp = item
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            position = int(round((timestamp - first_timestamp) * self.fps))
+            while last_frame is not None and written < position:
+                out.write(last_frame)
+                written += 1
+            if written == position:
+                out.write(frame)
+                written += 1
+            last_frame = frame
+        out.release()
+        if self._aborted and os.path.exists(self.path):
+            os.remove(self.path)
+        elif self.dropped > 0:
+            logger.debug(f'encoder fell behind, dropped {self.dropped} frames from {self.path}')
+
+    def __getstate__(self):
+        # a stream can only be pickled once it's finished (e.g. when its event is spilled)
+        self.wait()
+        return {
+            'path': self.path,
+            'fps': self.fps,
+            'dropped': self.dropped,
+            'error': self.error
+            }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._thread = None
 
 
 class VideoOutput(MediaOutput):
-    def __init__(self, filetype='mp4'):
-        super(VideoOutput, self).__init__(filetype)
+    config_name = 'video'
+
+    def __init__(self, filetype='mp4', create=True):
+        super(VideoOutput, self).__init__(filetype, create)
+        self.fourcc = self._config['fourcc']
+        self._streams = weakref.WeakSet()
+        # poster timestamp: whether it was queued, and an event that's set once it's been tried
+        self._posters = {}
+        self._posters_lock = threading.Lock()
+        self._transcoder = None
+        self._transcoding = set()
+        self.transcode_root = os.path.join(config.root, 'transcode')
+        if create and not os.path.exists(self.transcode_root):
+            os.mkdir(self.transcode_root)
+
+    def load_config(self):
+        video_config = super(VideoOutput, self).load_config()
+        basic_config = config.output_config.get(self.config_name, {})
+        # either a list of names, or names mapped to their options
+        renditions = basic_config.get('renditions', {})
+        if isinstance(renditions, list):
+            renditions = {r: {} for r in renditions}
+        video_config.update({
+            'streaming': basic_config.get('streaming', False),
+            'fourcc': basic_config.get('fourcc', 'X264'),
+            'poster': basic_config.get('poster', True),
+            'poster_quality': basic_config.get('poster_quality', 85),
+            'notify_clip': basic_config.get('notify_clip', False),
+            'renditions': renditions,
+            'transcode_workers': basic_config.get('transcode_workers', 1),
+            'transcode_nice': basic_config.get('transcode_nice', 10),
+            'stale_seconds': basic_config.get('stale_seconds', 600)
+            })
+        return video_config
+
+    @property
+    def streaming(self):
+        return self._config['streaming']
+
+    def open_stream(self, shape, fps):
+        """
+        Start encoding an event's frames as they arrive.
+
+        :param shape: the shape of each frame
+        :param fps: the capture frame rate
+        :return: VideoStream
+
+        """
+        path = os.path.join(self.file_root, f'temp_{time.time():.6f}.' + self.filetype)
+        stream = VideoStream(path, shape, fps, self.fourcc)
+        self._streams.add(stream)
+        return stream
+
+    def in_use(self):
+        return {s.path for s in self._streams if s.path.startswith(self.file_root)}
 
     def fire(self, frames, fps, **kwargs):
+        """
+        Write (or finish writing) the video, then rename and upload it.
+
+        :param frames: either the event's frames, or an already-encoded clip with a .save(path)
+            method (e.g. a closed VideoStream)
+        :param fps: frames per second for the output video
+        :param poster: the timestamp passed to poster() for this event, if there was one
+
+        """
         self.processing = True
         centroids = kwargs.get('centroids', None)
         if centroids is not None:
-            direction = 1 if centroids[0] > centroids[-1] else 0
-            if centroids[0] == centroids[-1]:
-                direction = 2
-            self.set_direction(direction)
-        self.make_video(frames, fps)
-        super(VideoOutput, self).fire()
+            self.set_direction(self.get_direction(centroids))
+        with stage('encode'):
+            try:
+                if hasattr(frames, 'save'):
+                    frames.save(self.initial)
+                else:
+                    try:
+                        self.make_video(frames, fps)
+                    finally:
+                        if hasattr(frames, 'release'):
+                            # get rid of any frames that were spilled to disk
+                            frames.release()
+            except Exception:
+                # there's nothing worth uploading; self.path is still the last event's clip, which
+                # may not have been uploaded yet, so only this event's temp files go
+                stale = [self.initial]
+                if isinstance(frames, VideoStream):
+                    stale.append(frames.path)
+                for f in stale:
+                    if os.path.exists(f):
+                        os.remove(f)
+                self.filename_set = False
+                self.processing = False
+                raise
+        if isinstance(frames, VideoStream) and frames.dropped:
+            registry.counter('ginji_dropped_frames_total', reason='encoder').inc(frames.dropped)
+        # if a poster went out, the notifiers have already been told about this event
+        with self._posters_lock:
+            poster = self._posters.pop(kwargs.get('poster', None), None)
+        if poster is not None:
+            poster['done'].wait()
+        notify = poster is None or not poster['queued'] or self._config['notify_clip']
+        super(VideoOutput, self).fire(notify=notify)
+
+    @staticmethod
+    def get_direction(centroids):
+        if centroids[0] == centroids[-1]:
+            return 2
+        return 1 if centroids[0] > centroids[-1] else 0
+
+    def poster(self, frame, timestamp, centroids=None):
+        """
+        Save a single frame from early in an event as a jpeg and queue it, so it can be uploaded
+        and notified about while the video is still being recorded.
+
+        :param frame: the frame to use, e.g. the one with the most movement so far
+        :param timestamp: when the frame was captured
+        :param centroids: the horizontal position of the movement so far, for the direction
+        :return: True if a poster is on its way; it's saved on a thread of its own, so it doesn't
+            wait behind earlier events
+
+        """
+        if not self._config['poster']:
+            return False
+        poster = {'queued': False, 'done': threading.Event()}
+        # recorded before the thread starts, so fire() knows about it however quickly it runs
+        with self._posters_lock:
+            self._posters[timestamp] = poster
+            # events that were dropped are never fired, so only keep the latest few
+            while len(self._posters) > 32:
+                del self._posters[next(iter(self._posters))]
+        threading.Thread(target=self._save_poster, args=(frame, timestamp, centroids, poster),
+                         name='ginji-poster', daemon=True).start()
+        return True
+
+    def _save_poster(self, frame, timestamp, centroids, poster):
+        try:
+            import cv2
+            direction = self.get_direction(centroids) if centroids else 2
+            path = self.make_filename(timestamp, direction, 'jpg')
+            ok, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self._config['poster_quality']])
+            if not ok:
+                logger.error(f'Unable to encode the poster for {timestamp}.')
+                return
+            with open(path, 'wb') as file:
+                file.write(jpeg.tobytes())
+            self.upload_queue.add(path, timestamp, self.describe(direction))
+            poster['queued'] = True
+            logger.debug(f'queued poster {os.path.basename(path)}')
+        except Exception as e:
+            logger.error(f'Unable to save the poster for {timestamp}: {e}')
+        finally:
+            poster['done'].set()
 
     def make_video(self, frames, fps):
-        fourcc = cv2.VideoWriter_fourcc(*'X264')
+        """
+        Write frames to the temporary video file. Raises IOError if there's no encoder for the
+        fourcc, e.g. X264 with an OpenCV build that doesn't include it.
+
+        :param frames: any sized iterable of frames, e.g. a FrameBuffer; frames are read in place
+        :param fps: frames per second for the output video
+
+        """
+        if len(frames) == 0:
+            return
+        import cv2
+        fourcc = cv2.VideoWriter_fourcc(*self.fourcc)
         shape = frames[0].shape[1::-1]
         out = cv2.VideoWriter(self.initial, fourcc, fps,
                               shape, True)
+        if not out.isOpened():
+            raise IOError(f'Unable to open a {self.fourcc} encoder for {self.initial}.')
         for f in frames:
             out.write(f)
         out.release()
 
-    def convert(self, newtype):
-        ff = ffmpy.FFmpeg(inputs={
-            self.path: None
-            }, outputs={
-            self.path.replace(self.filetype, newtype): None
-            }, global_options=['-nostats -loglevel 0'])
-        ff.run()
-        self.clean()
-        self.path = self.path.replace(self.filetype, newtype)
+    @property
+    def transcoder(self):
+        if self._transcoder is None:
+            # spawned rather than forked: this is called from an output thread, and forking a
+            # process full of threads is asking for trouble
+            self._transcoder = ProcessPoolExecutor(self._config['transcode_workers'],
+                                                   mp_context=multiprocessing.get_context('spawn'),
+                                                   initializer=lower_priority,
+                                                   initargs=(self._config['transcode_nice'],))
+        return self._transcoder
+
+    def connect(self, notify=True, **kwargs):
+        if self._config['renditions']:
+            self.transcode(self.path)
+        return super(VideoOutput, self).connect(notify, **kwargs)
+
+    def transcode(self, path):
+        """
+        Make the configured renditions of a finished video in the background. Each one is
+        queued for upload by itself as soon as it's ready.
+
+        :param path: the video; the transcoder works on a hard link to it, so the video itself
+            can be uploaded (and deleted) without waiting
+
+        """
+        jobs = {name: options for name, options in self._config['renditions'].items()
+                if name in renditions}
+        for name in set(self._config['renditions']) - set(jobs):
+            logger.error(f'Unknown rendition "{name}"; use one of {", ".join(renditions)}.')
+        if not jobs or not os.path.exists(path):
+            return
+        source = os.path.join(self.transcode_root, os.path.basename(path))
+        try:
+            os.link(path, source)
+        except OSError:
+            # some filesystems (e.g. FAT) can't do links
+            shutil.copy2(path, source)
+        stem = os.path.splitext(path)[0]
+        time_taken, direction_msg = self.time_taken, self.direction_msg
+        remaining = [len(jobs)]
+        lock = threading.Lock()
+
+        def finished(future):
+            try:
+                rendition = future.result()
+                self.upload_queue.add(rendition, time_taken, direction_msg, notify=False)
+                logger.debug(f'made {os.path.basename(rendition)}')
+            except Exception as e:
+                logger.error(f'Unable to make a rendition of {path}: {e}')
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                os.remove(source)
+                self._transcoding.discard(source)
+
+        self._transcoding.add(source)
+        for name, options in jobs.items():
+            options = dict(options)
+            filetype = options.pop('format', renditions[name][1])
+            self.transcoder.submit(render, name, source, f'{stem}-{name}.{filetype}',
+                                   options).add_done_callback(finished)
+
+    def tidy(self, workers=1, progress=None):
+        # anything else in here that hasn't changed for stale_seconds was left behind by a transcoder
+        # that didn't get to finish; newer files may belong to another process's pool
+        cutoff = time.time() - self._config['stale_seconds']
+        transcoding = [os.path.splitext(t)[0] for t in list(self._transcoding)]
+        for e in os.scandir(self.transcode_root):
+            if any(os.path.splitext(e.path)[0].startswith(t) for t in transcoding):
+                continue
+            try:
+                if e.stat().st_mtime < cutoff:
+                    os.remove(e.path)
+            except FileNotFoundError:
+                # its transcoder finished with it in the meantime
+                pass
+        self.remove_stale()
+        super(VideoOutput, self).tidy(workers, progress)
+
+    def remove_stale(self):
+        """
+        Delete streams and h264 recordings that were left unfinished by a crash or a dropped event.
+        Anything that's still being written has been touched recently, so only files that haven't
+        changed for stale_seconds go (sweep can run alongside motion, and can't see its streams).
+
+        :return: the number of files deleted
+
+        """
+        cutoff = time.time() - self._config['stale_seconds']
+        in_use = self.in_use()
+        groups = {}
+        for e in os.scandir(self.file_root):
+            if e.name.startswith('temp_') and e.path not in in_use:
+                groups[e.path] = [e]
+        # where MotionInput's h264 recorder keeps the two halves of each clip, named
+        # <time>-before.h264 and <time>-after.h264; they go together, once neither is being written
+        recordings = os.path.join(config.root, 'recordings')
+        if os.path.exists(recordings):
+            for e in os.scandir(recordings):
+                if e.name.endswith('.h264'):
+                    groups.setdefault(os.path.join(recordings, e.name.split('-')[0]), []).append(e)
+        removed = 0
+        for files in groups.values():
+            if max(e.stat().st_mtime for e in files) < cutoff:
+                for e in files:
+                    os.remove(e.path)
+                    removed += 1
+        if removed:
+            logger.debug(f'removed {removed} stale stream and recording files')
+        return removed
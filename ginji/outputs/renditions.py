@@ -0,0 +1,87 @@
+"""
+Extra versions of a finished video, made in a pool of low-priority processes so they never hold
+up capture or detection. Each function takes the source video, where to write the result, and
+that rendition's options from the config. Their imports are inside them, so the output can be
+loaded without them (e.g. for a sweep).
+"""
+
+import os
+import subprocess
+
+
+def small(source, path, height=360, bitrate='400k', **kwargs):
+    """A low-bitrate copy that's quick to upload and stream."""
+    import ffmpy
+    ffmpy.FFmpeg(inputs={
+        source: None
+        }, outputs={
+        path: f'-vf scale=-2:{height} -c:v libx264 -preset veryfast -b:v {bitrate} -an -y'
+        }, global_options=['-nostats -loglevel 0']).run()
+
+
+def preview(source, path, width=320, fps=5, seconds=4, **kwargs):
+    """A short animated preview; webp or gif, depending on the extension."""
+    import ffmpy
+    codec = '-c:v libwebp -q:v 50' if path.endswith('.webp') else ''
+    ffmpy.FFmpeg(inputs={
+        source: f'-t {seconds}'
+        }, outputs={
+        path: f'-vf fps={fps},scale={width}:-1 -loop 0 {codec} -an -y'
+        }, global_options=['-nostats -loglevel 0']).run()
+
+
+def strip(source, path, count=6, width=160, **kwargs):
+    """Evenly spaced thumbnails from the whole video, side by side in one jpeg."""
+    import cv2
+    import numpy as np
+    video = cv2.VideoCapture(source)
+    total = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    thumbs = []
+    for i in np.linspace(0, max(total - 1, 0), count).astype(int):
+        video.set(cv2.CAP_PROP_POS_FRAMES, i)
+        ok, frame = video.read()
+        if not ok:
+            continue
+        height = round(frame.shape[0] * width / frame.shape[1])
+        thumbs.append(cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA))
+    video.release()
+    if not thumbs:
+        raise ValueError(f'could not read any frames from {source}')
+    cv2.imwrite(path, np.hstack(thumbs))
+
+
+renditions = {
+    'small': (small, 'mp4'),
+    'preview': (preview, 'webp'),
+    'strip': (strip, 'jpg')
+    }
+
+
+def lower_priority(niceness):
+    """Run in each worker as it starts, so it (and any ffmpeg it starts) yields to capture."""
+    os.nice(niceness)
+    try:
+        # idle io class: only gets the disk when nothing else wants it
+        subprocess.run(['ionice', '-c', '3', '-p', str(os.getpid())], check=False,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError:
+        pass
+
+
+def render(name, source, path, options):
+    """
+    Make one rendition. It's written next to the source first and moved into place when it's
+    finished, so nothing picks up a half-written file.
+
+    :param name: a key in renditions
+    :param source: the finished video
+    :param path: where the rendition should end up
+    :param options: keyword arguments for the rendition function
+    :return: path
+
+    """
+    make, _ = renditions[name]
+    tmp = os.path.join(os.path.dirname(source), os.path.basename(path))
+    make(source, tmp, **options)
+    os.replace(tmp, path)
+    return path
@@ -0,0 +1,464 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import quote
+
+from ginji.config import config, logger
+from ginji.metrics import registry
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    connector TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    context TEXT,
+    result TEXT,
+    error TEXT,
+    owner INTEGER,
+    claimed REAL,
+    UNIQUE (path, connector)
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, next_attempt);
+CREATE INDEX IF NOT EXISTS jobs_path ON jobs (path);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    hash TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    added REAL NOT NULL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS files_status ON files (status);
+CREATE INDEX IF NOT EXISTS files_hash ON files (hash, size);
+CREATE TABLE IF NOT EXISTS scans (
+    directory TEXT PRIMARY KEY,
+    mtime REAL NOT NULL
+);
+'''
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_ledger(path=None):
+    """
+    Read every file's state from the ledger without changing anything, e.g. for a dry run, or
+    while another process is working through the queue.
+
+    :param path: the database; defaults to the one UploadQueue uses
+    :return: a dict of path: status ('pending', 'done' or 'missing')
+
+    """
+    path = path or os.path.join(config.root, 'uploads.db')
+    if not os.path.exists(path):
+        return {}
+    db = sqlite3.connect(f'file:{quote(path)}?mode=ro', uri=True)
+    try:
+        return dict(db.execute('SELECT path, status FROM files').fetchall())
+    finally:
+        db.close()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # it's there, it just belongs to someone else
+        pass
+    return True
+
+
+class UploadQueue(object):
+    """
+    A job queue on disk (SQLite) for running connectors against media files. Each file gets one
+    job per connector; uploads for a file run in parallel on a pool of worker threads, and each
+    notifier runs as soon as the uploads it needs have finished. Failed jobs are retried with
+    exponential backoff, and the file is deleted once every job for it has succeeded.
+
+    Jobs survive restarts: anything that was running when its process died is picked up again
+    (but not jobs another process, e.g. a sweep alongside motion, is still running), and a file
+    is never queued twice for the same connector. The same database keeps a ledger of every
+    file's size, hash and state, so a file that has already been uploaded (even under another
+    name) isn't uploaded again, and tidying only has to look at what's still pending.
+    """
+
+    def __init__(self, connectors, path=None, workers=2, retry_base=30, retry_max=3600,
+                 keep_days=90):
+        self.connectors = {c.config_name: c for c in connectors}
+        self.path = path or os.path.join(config.root, 'uploads.db')
+        self.workers = max(1, workers)
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._threads = []
+        self._running = 0
+        # connector: when its current batch of notifications goes out
+        self._windows = {}
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+        columns = [r[1] for r in self._db.execute('PRAGMA table_info(jobs)').fetchall()]
+        for column, column_type in [('owner', 'INTEGER'), ('claimed', 'REAL')]:
+            if column not in columns:
+                self._db.execute(f'ALTER TABLE jobs ADD COLUMN {column} {column_type}')
+        registry.gauge('ginji_upload_jobs_pending', 'Connector jobs waiting to run.', fn=self._pending_jobs)
+        self._requeue()
+        # forget finished files eventually, or the ledger just keeps growing
+        cutoff = time.time() - keep_days * 86400
+        self._db.execute("DELETE FROM jobs WHERE path IN (SELECT path FROM files "
+                         "WHERE status != 'pending' AND finished < ?)", (cutoff,))
+        self._db.execute("DELETE FROM files WHERE status != 'pending' AND finished < ?", (cutoff,))
+
+    def _requeue(self):
+        # pick up jobs whose process has gone; a pid from before the last boot could belong to
+        # anything by now
+        booted = time.time() - time.monotonic()
+        requeued = 0
+        for owner, claimed in self._db.execute("SELECT DISTINCT owner, claimed FROM jobs "
+                                               "WHERE status = 'running'").fetchall():
+            if owner is None or owner == os.getpid() or claimed is None or claimed < booted or \
+                    not _alive(owner):
+                requeued += self._db.execute("UPDATE jobs SET status = 'pending', owner = NULL "
+                                             "WHERE status = 'running' AND owner IS ? "
+                                             "AND claimed IS ?", (owner, claimed)).rowcount
+        if requeued:
+            logger.debug(f'requeued {requeued} interrupted upload jobs')
+
+    def add(self, path, time_taken=None, direction_msg='', notify=True):
+        """
+        Record a file in the ledger and queue every connector for it. A file with the same
+        contents as one that's already been uploaded is marked as done straight away, and so is
+        every file when there aren't any connectors.
+
+        :param path: the media file
+        :param time_taken: passed on to the notifiers
+        :param direction_msg: passed on to the notifiers
+        :param notify: if False, the notifiers are marked as skipped for this file (e.g. because
+            they've already been told about the event)
+        :return: the number of new jobs (0 if there was nothing new to do)
+
+        """
+        st = os.stat(path)
+        with self._lock:
+            row = self._db.execute('SELECT size, mtime, hash, status FROM files WHERE path = ?',
+                                   (path,)).fetchone()
+        if row is not None and row[:2] == (st.st_size, st.st_mtime):
+            digest = row[2]
+        else:
+            # hashing is the slow bit, so it happens outside the lock
+            digest = file_hash(path)
+        context = json.dumps([time_taken, direction_msg])
+        with self._lock:
+            if row is not None and (row[2] != digest or row[3] == 'missing'):
+                # different contents under an old name, or a file that's come back: start again
+                self._db.execute('DELETE FROM jobs WHERE path = ?', (path,))
+                row = None
+            if row is None:
+                self._db.execute('INSERT OR REPLACE INTO files (path, size, mtime, hash, added) '
+                                 'VALUES (?, ?, ?, ?, ?)',
+                                 (path, st.st_size, st.st_mtime, digest, time.time()))
+            before = self._db.total_changes
+            self._db.executemany('INSERT OR IGNORE INTO jobs (path, connector, kind, status, context) '
+                                 'VALUES (?, ?, ?, ?, ?)',
+                                 [(path, name, c.connector_type,
+                                   'pending' if notify or c.connector_type != 'notifier' else 'skipped',
+                                   context) for name, c in self.connectors.items()])
+            added = self._db.total_changes - before
+            if added:
+                self._db.execute("UPDATE files SET status = 'pending' WHERE path = ?", (path,))
+                if self._copy_done(path, digest, st.st_size):
+                    added = 0
+            elif row is not None and row[3] == 'done':
+                # already uploaded, but still lying around
+                self._finish(path)
+            elif not self.connectors:
+                # nowhere to send it, so it's as finished as it's going to get
+                self._finish(path)
+            self._wake.notify_all()
+        if added:
+            self.start()
+        return added
+
+    def _copy_done(self, path, digest, size):
+        # if these contents have already been uploaded, reuse the results
+        original = self._db.execute("SELECT path FROM files WHERE hash = ? AND size = ? AND "
+                                    "status = 'done' AND path != ? LIMIT 1",
+                                    (digest, size, path)).fetchone()
+        if original is None:
+            return False
+        self._db.execute("UPDATE jobs SET status = 'done', result = (SELECT result FROM jobs AS j "
+                         "WHERE j.path = ? AND j.connector = jobs.connector) "
+                         "WHERE path = ? AND status = 'pending' AND connector IN "
+                         "(SELECT connector FROM jobs WHERE path = ? AND status = 'done')",
+                         (original[0], path, original[0]))
+        logger.debug(f'{os.path.basename(path)} was already uploaded as '
+                     f'{os.path.basename(original[0])}')
+        self._finish(path)
+        return self._db.execute("SELECT 1 FROM jobs WHERE path = ? AND status = 'pending' LIMIT 1",
+                                (path,)).fetchone() is None
+
+    def pending(self):
+        """The files in the ledger that still have something left to do."""
+        with self._lock:
+            rows = self._db.execute("SELECT path FROM files WHERE status = 'pending'").fetchall()
+        return [r[0] for r in rows]
+
+    def scan(self, directory, suffix, ignore=None):
+        """
+        Find files in a directory that aren't in the ledger yet. The directory is only listed
+        if it has changed since the last scan.
+
+        :param directory: the folder to look in
+        :param suffix: only return files ending with this
+        :param ignore: skip files whose names start with this, e.g. ones still being written
+        :return: a list of paths
+
+        """
+        mtime = os.stat(directory).st_mtime
+        with self._lock:
+            last = self._db.execute('SELECT mtime FROM scans WHERE directory = ?',
+                                    (directory,)).fetchone()
+        if last is not None and last[0] == mtime:
+            return []
+        found = [e.path for e in os.scandir(directory) if e.is_file() and e.name.endswith(suffix)
+                 and not (ignore and e.name.startswith(ignore))]
+        with self._lock:
+            known = {f: self._db.execute('SELECT status FROM files WHERE path = ?',
+                                         (f,)).fetchone() for f in found}
+            # finished files that are still here either couldn't be deleted or are new copies
+            new = [f for f, row in known.items() if row is None or row[0] != 'pending']
+            self._db.execute('INSERT OR REPLACE INTO scans (directory, mtime) VALUES (?, ?)',
+                             (directory, mtime))
+        return new
+
+    def queued(self, path):
+        """Whether a file has any unfinished jobs."""
+        with self._lock:
+            row = self._db.execute("SELECT 1 FROM jobs WHERE path = ? AND "
+                                   "status NOT IN ('done', 'skipped') LIMIT 1", (path,)).fetchone()
+        return row is not None
+
+    def _ready(self, path, connector):
+        # notifiers wait for the uploads they need; None means every uploader for the file
+        requires = getattr(self.connectors[connector], 'requires', None)
+        rows = self._db.execute("SELECT connector, status, result FROM jobs "
+                                "WHERE path = ? AND kind = 'uploader'", (path,)).fetchall()
+        if requires is None:
+            requires = [r[0] for r in rows]
+        else:
+            # an uploader that isn't set up for this file can't hold anything up
+            requires = [r for r in requires if r in {row[0] for row in rows}]
+        done = {r[0]: r[2] for r in rows if r[1] == 'done'}
+        if all(r in done for r in requires):
+            return done
+        return None
+
+    def _claim(self):
+        """:return: (connector, [(job id, path, context, uploads), ...]), or None"""
+        now = time.time()
+        rows = self._db.execute("SELECT id, path, connector, kind, context FROM jobs "
+                                "WHERE status = 'pending' AND next_attempt <= ? "
+                                "ORDER BY kind DESC, id", (now,)).fetchall()
+        for job_id, path, connector, kind, context in rows:
+            if connector not in self.connectors:
+                continue
+            uploads = None
+            if kind == 'notifier':
+                uploads = self._ready(path, connector)
+                if uploads is None:
+                    continue
+                window = getattr(self.connectors[connector], 'coalesce_seconds', 0)
+                if window > 0:
+                    batch = self._claim_batch(connector, window, rows, now)
+                    if batch is None:
+                        continue
+                    return batch
+            # another process may be working through the same queue
+            if not self._claim_job(job_id, now):
+                continue
+            self._running += 1
+            return connector, [(job_id, path, json.loads(context), uploads)]
+        return None
+
+    def _claim_job(self, job_id, now):
+        return self._db.execute("UPDATE jobs SET status = 'running', owner = ?, claimed = ? "
+                                "WHERE id = ? AND status = 'pending'",
+                                (os.getpid(), now, job_id)).rowcount > 0
+
+    def _claim_batch(self, connector, window, rows, now):
+        # hold a coalescing notifier's jobs back until its window closes, rather than tying up a
+        # worker, then send everything that's ready by then together
+        deadline = self._windows.setdefault(connector, now + window)
+        if now < deadline:
+            self._db.execute("UPDATE jobs SET next_attempt = ? WHERE connector = ? AND status = 'pending' "
+                             "AND next_attempt < ?", (deadline, connector, deadline))
+            return None
+        del self._windows[connector]
+        batch = []
+        for job_id, path, c, kind, context in rows:
+            if c != connector:
+                continue
+            uploads = self._ready(path, connector)
+            if uploads is not None and self._claim_job(job_id, now):
+                batch.append((job_id, path, json.loads(context), uploads))
+        if not batch:
+            return None
+        self._running += 1
+        return connector, batch
+
+    def _next_due(self):
+        row = self._db.execute("SELECT MIN(next_attempt) FROM jobs WHERE status = 'pending' "
+                               "AND next_attempt > ?", (time.time(),)).fetchone()
+        return row[0]
+
+    def _run(self):
+        while True:
+            with self._lock:
+                job = self._claim()
+                while job is None:
+                    due = self._next_due()
+                    self._wake.wait(None if due is None else max(0.1, due - time.time()))
+                    job = self._claim()
+            self._do(*job)
+
+    def _do(self, connector, jobs):
+        c = self.connectors[connector]
+        path = jobs[0][1]
+        result = None
+        error = None
+        if c.connector_type == 'uploader' and not os.path.exists(path):
+            # nothing left to upload, so give up on the whole file
+            with self._lock:
+                self._running -= 1
+                self._db.execute("UPDATE jobs SET status = 'missing' WHERE path = ? AND "
+                                 "status NOT IN ('done', 'skipped')", (path,))
+                self._db.execute("UPDATE files SET status = 'missing', finished = ? WHERE path = ?",
+                                 (time.time(), path))
+                logger.error(f'{path} has disappeared; it won\'t be uploaded.')
+                self._wake.notify_all()
+            return
+        size = os.path.getsize(path) if c.connector_type == 'uploader' else 0
+        try:
+            with registry.histogram('ginji_connector_seconds', 'Time taken by each connector job.',
+                                    connector=connector).time():
+                if c.connector_type == 'uploader':
+                    result = c.run(path)
+                elif getattr(c, 'coalesce_seconds', 0) > 0:
+                    c.run_batch([(uploads, *context) for _, _, context, uploads in jobs])
+                else:
+                    _, _, (time_taken, direction_msg), uploads = jobs[0]
+                    c.run(uploads, time_taken, direction_msg)
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            registry.counter('ginji_connector_failures_total', 'Connector jobs that failed and will be retried.',
+                             connector=connector).inc()
+        else:
+            if size:
+                registry.counter('ginji_uploaded_bytes_total', 'Bytes uploaded by each uploader.',
+                                 connector=connector).inc(size)
+        with self._lock:
+            self._running -= 1
+            for job_id, path, _, _ in jobs:
+                if error is None:
+                    self._db.execute("UPDATE jobs SET status = 'done', result = ?, error = NULL "
+                                     "WHERE id = ?", (result, job_id))
+                    logger.debug(f'{connector} finished with {os.path.basename(path)}')
+                    self._finish(path)
+                else:
+                    attempts = self._db.execute('SELECT attempts FROM jobs WHERE id = ?',
+                                                (job_id,)).fetchone()[0] + 1
+                    delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+                    self._db.execute("UPDATE jobs SET status = 'pending', attempts = ?, "
+                                     "next_attempt = ?, error = ? WHERE id = ?",
+                                     (attempts, time.time() + delay, error, job_id))
+                    logger.error(f'Unable to run {connector} for {path} ({error}); retrying in '
+                                 f'{delay:.0f}s.')
+            self._wake.notify_all()
+
+    def _finish(self, path):
+        remaining = self._db.execute("SELECT 1 FROM jobs WHERE path = ? AND "
+                                     "status NOT IN ('done', 'skipped') LIMIT 1", (path,)).fetchone()
+        if remaining is not None:
+            return
+        self._db.execute("UPDATE files SET status = 'done', finished = ? WHERE path = ?",
+                         (time.time(), path))
+        if os.path.exists(path):
+            os.remove(path)
+            logger.debug(f'Cleaning up {path}.')
+
+    def start(self):
+        # threads don't survive a fork, so count the ones that are actually running
+        self._threads = [t for t in self._threads if t.is_alive()]
+        while len(self._threads) < self.workers:
+            t = threading.Thread(target=self._run, name=f'ginji-upload-{len(self._threads)}',
+                                 daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def wait(self, progress=None):
+        """
+        Block until nothing is running and nothing else is due; jobs in backoff are left.
+
+        :param progress: optional callable, called about once a second while waiting
+
+        """
+        while True:
+            with self._lock:
+                if self._running == 0 and not self._due():
+                    return
+                self._wake.wait(1)
+            if progress is not None:
+                progress()
+
+    def status(self, path):
+        """The ledger's state for a file: 'pending', 'done', 'missing', or None if it's new."""
+        with self._lock:
+            row = self._db.execute('SELECT status FROM files WHERE path = ?', (path,)).fetchone()
+        return None if row is None else row[0]
+
+    def finished_since(self, since):
+        """
+        :param since: a unix timestamp
+        :return: (the number of files finished since then, their total size in bytes)
+
+        """
+        with self._lock:
+            row = self._db.execute("SELECT COUNT(*), TOTAL(size) FROM files WHERE status = 'done' "
+                                   "AND finished >= ?", (since,)).fetchone()
+        return row[0], int(row[1])
+
+    def _due(self):
+        # notifications held back for a batch are as good as due
+        if any(deadline > time.time() for deadline in self._windows.values()):
+            return True
+        rows = self._db.execute("SELECT path, connector, kind FROM jobs WHERE status = 'pending' "
+                                "AND next_attempt <= ?", (time.time(),)).fetchall()
+        return any(c in self.connectors and (k == 'uploader' or self._ready(p, c) is not None)
+                   for p, c, k in rows)
+
+    def _pending_jobs(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'pending'").fetchone()[0]
+
+    def stats(self):
+        with self._lock:
+            rows = self._db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        counts = {'pending': 0, 'running': 0, 'done': 0, 'skipped': 0, 'missing': 0}
+        counts.update(dict(rows))
+        return counts
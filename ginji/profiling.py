@@ -0,0 +1,100 @@
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+
+from ginji.config import config, logger
+
+
+def output_path(kind, extension):
+    """Somewhere in config.root to put a profile."""
+    root = os.path.join(config.root, 'profiles')
+    if not os.path.exists(root):
+        os.makedirs(root)
+    return os.path.join(root, f'{kind}_{time.strftime("%Y%m%d-%H%M%S")}.{extension}')
+
+
+class SamplingProfiler(object):
+    """
+    Looks at what every thread is doing every interval seconds, from a thread of its own. It's
+    cheap enough to leave running on the live pipeline, unlike cProfile, and sees all the threads
+    rather than just one. Results are written as collapsed stacks, ready for flamegraph.pl or
+    speedscope.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self.stacks.clear()
+        self.samples = 0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='ginji-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def write(self, path):
+        """
+        Write the collapsed stacks, one "frame;frame;frame count" line per stack.
+
+        :param path: the output file
+        :return: path
+
+        """
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        return path
+
+
+def install_toggle(signum=signal.SIGUSR1, interval=0.005):
+    """
+    Start the sampling profiler when the process gets signum, and stop it and write the stacks
+    out the next time, e.g. kill -USR1 <pid>.
+
+    :return: the profiler
+
+    """
+    profiler = SamplingProfiler(interval)
+
+    def toggle(*args):
+        if profiler.running:
+            profiler.stop()
+            path = profiler.write(output_path('sample', 'collapsed'))
+            logger.info(f'profiling stopped after {profiler.samples} samples; wrote {path}')
+        else:
+            profiler.start()
+            logger.info(f'profiling started; send signal {signum} again to stop')
+
+    signal.signal(signum, toggle)
+    return profiler
@@ -0,0 +1,64 @@
+"""
+Where to find each input, output and connector, by name, so that nothing is imported until it's
+actually used: a sweep shouldn't have to load the camera, and a tidy with only S3 configured
+shouldn't have to load the Google API client. Other packages can add their own through the
+'ginji.inputs', 'ginji.outputs' and 'ginji.connectors' entry point groups.
+"""
+
+import importlib
+
+builtins = {
+    'inputs': {
+        'motion': 'ginji.inputs.motion:MotionInput'
+        },
+    'outputs': {
+        'text': 'ginji.outputs.text:TextOutput',
+        'video': 'ginji.outputs.media:VideoOutput'
+        },
+    'connectors': {
+        's3': 'ginji.connectors.s3_uploader:S3Uploader',
+        'google_drive': 'ginji.connectors.drive_uploader:GoogleDriveUploader',
+        'ifttt': 'ginji.connectors.ifttt_notifier:IFTTTNotifier'
+        }
+    }
+
+_plugins = None
+
+
+def _entry_points():
+    global _plugins
+    if _plugins is None:
+        from importlib import metadata
+        eps = metadata.entry_points()
+        _plugins = {}
+        for kind in builtins:
+            group = f'ginji.{kind}'
+            # python < 3.10 gives a dict of groups instead
+            found = eps.select(group=group) if hasattr(eps, 'select') else eps.get(group, [])
+            _plugins[kind] = {ep.name: ep.value for ep in found}
+    return _plugins
+
+
+def available(kind):
+    """
+    :param kind: 'inputs', 'outputs' or 'connectors'
+    :return: a dict of name: 'module:attribute' for everything that can be loaded
+
+    """
+    return {**_entry_points()[kind], **builtins[kind]}
+
+
+def load(kind, name):
+    """
+    Import and return a single input, output or connector class.
+
+    :param kind: 'inputs', 'outputs' or 'connectors'
+    :param name: its config name, e.g. 's3'
+    :return: the class
+
+    """
+    target = builtins[kind].get(name) or _entry_points()[kind].get(name)
+    if target is None:
+        raise KeyError(f'Unknown {kind[:-1]} "{name}"; use one of {", ".join(available(kind))}.')
+    module, attribute = target.split(':')
+    return getattr(importlib.import_module(module), attribute)
@@ -0,0 +1,86 @@
+"""
+Measure how long each command spends importing things before it does anything, using python's
+-X importtime in a fresh interpreter per command so nothing is already cached.
+
+    python -m ginji.startup --repeat 3
+"""
+
+import subprocess
+import sys
+
+import click
+
+_cli = 'import ginji.cli.core as core\n'
+_connectors = ('from ginji.config import config\n'
+               'known = core.registry.available("connectors")\n'
+               'for k, v in config.connector_config.items():\n'
+               '    if v.get("active", True) and k in known:\n'
+               '        core.registry.load("connectors", k)\n')
+
+# what each command has imported by the time it starts working
+commands = {
+    'help': _cli,
+    'stats': _cli,
+    'sweep': _cli + 'core.registry.load("outputs", "video")\n' + _connectors,
+    'motion': _cli + 'core.registry.load("outputs", "video")\n' + _connectors +
+              'core.registry.load("inputs", "motion")\n'
+    }
+
+
+def measure(command):
+    """
+    Import everything command would in a new interpreter.
+
+    :param command: a key in commands
+    :return: (total import seconds, {top level package: seconds}); raises RuntimeError if any of
+             the imports fail
+
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', commands[command]],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    packages = {}
+    lines = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            lines.append(line)
+            continue
+        own, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        packages[package] = packages.get(package, 0) + int(own) / 1e6
+    if result.returncode != 0:
+        raise RuntimeError(lines[-1] if lines else f'exited with {result.returncode}')
+    return sum(packages.values()), packages
+
+
+def benchmark(repeat=3):
+    """
+    :param repeat: runs per command; the fastest is kept, since the others are just noise
+    :return: a dict of command: (seconds, packages) or command: error message
+
+    """
+    results = {}
+    for command in commands:
+        try:
+            results[command] = min((measure(command) for _ in range(repeat)), key=lambda x: x[0])
+        except RuntimeError as e:
+            results[command] = str(e)
+    return results
+
+
+@click.command()
+@click.option('--repeat', type=int, default=3, help='Runs per command.')
+@click.option('--top', type=int, default=5, help='How many of the slowest packages to show.')
+def main(repeat, top):
+    for command, result in benchmark(repeat).items():
+        if isinstance(result, str):
+            click.echo(f'{command}: failed ({result})')
+            continue
+        seconds, packages = result
+        heaviest = sorted(packages.items(), key=lambda x: -x[1])[:top]
+        click.echo(f'{command}: {seconds * 1000:.0f}ms')
+        for package, package_seconds in heaviest:
+            click.echo(f'    {package}: {package_seconds * 1000:.0f}ms')
+
+
+if __name__ == '__main__':
+    main()
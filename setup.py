@@ -6,7 +6,7 @@ from setuptools import find_packages, setup
 NAME = 'ginji'
 DESCRIPTION = 'Raspberry Pi inputs and outputs. Mostly centred around motion detection and video capture.'
 URL = 'https://github.com/alycejenni/catflap'
-REQUIRES_PYTHON = '>=3.6.0'
+REQUIRES_PYTHON = '>=3.8.0'
 VERSION = '0.1.1'
 
 with open('requirements.txt', 'r') as req_file:
@@ -21,6 +21,9 @@ setup(
     url=URL,
     packages=find_packages(exclude=('tests',)),
     install_requires=REQUIRED,
+    extras_require={
+        'bench': ['moto>=5']
+        },
     include_package_data=True,
     package_data={
         'ginji': []
@@ -34,7 +37,7 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.8',
         'Programming Language :: Python :: Implementation :: CPython'
         ]
     )